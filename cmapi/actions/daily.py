@@ -1,77 +1,232 @@
-def daily(cid,tags=[]):
-    # retrieve the catalogue record created by the daily journaltocs scrape
-    print "getting catalogue record"
-    try:
-        rec = requests.get('http://localhost:9200/contentmine/catalogue/' + cid).json()['_source']
-    except:
-        return {"errors": "this ID does not exist in our catalogue"}
-    
-    d = '/opt/contentmine/src/site/portality/static/scraping/'
-    outputdirectory = d + cid
-    if not os.path.exists(outputdirectory): os.makedirs(outputdirectory)
-    url = rec['link'][0]['url']
-
-    # run quickscrape to get metadata
-
-    # run norma to get a normalised version of the xml file ready for processing
-
-    # run species
-
-    # run regex (using a concatenated file of all current regexes, which needs produced somehow)
-
-    # send facts to the index
-    print "facts"
-    if 'daily' not in tags: tags.append('daily')
-    timestamp = datetime.now().strftime("%Y%m%d")
-    if timestamp not in tags: tags.append(timestamp)
-    for fact in facts:
-        if getkeywords:
-            fact['keywords'] = requests.get('http://cottagelabs.com/parser?blurb="' + fact['pre'] + ' ' + fact['fact'] + ' ' + fact['post'] + '"').json()
-            time.sleep(0.05)
-        # send the fact to the fact api
-        fact['tags'] = tags
-        fact['source'] = cid
-        requests.post('http://localhost:9200/contentmine/fact', data=json.dumps(fact))
-
-
-
-def getdailies():
-    dy = datetime.now() - timedelta(days=1)
-    fdy = dy.strftime("%Y-%m-%d %H%M")
-    print "getting dailies since ", fdy
-    q = {
-        "query": {
-            "filtered": {
-                "filter": {
-                    "bool": {
-                        "must": [
-                            {
-                                "term": {
-                                    "tags.exact": "daily"
-                                }
-                            },
-                            {
-                                "range": {
-                                    "created_date": {
-                                        "gte":  fdy
+
+'''
+The daily harvest of facts from the articles added to the catalogue by the daily journaltocs scrape
+Catalogue records are paged through oldest first, DAILY_PAGE at a time, each page a fresh query from the last
+created_date seen - a scroll would have to be kept open for as long as a page takes to process. For each page
+the articles are fetched and normalised DAILY_WORKERS at a time, then each ami2 processor is run over the
+whole page in batches, and the facts found are sent to the index.
+Progress is checkpointed in DAILY_DB - each cid is recorded once its facts are indexed, or as failed if it
+could not be fetched and normalised, and the created_date up to which every record is settled is kept as a
+high water mark. A run starts from the high water mark of the last one (or a day ago on the first run) and
+skips cids already done, so a run that crashes part way through carries on from where it stopped. Failed
+cids are tried again by later runs, up to DAILY_RETRIES times, as are cids an ami2 processor failed or timed out
+on, or could not get an admission slot for.
+Run it with python -m cmapi.actions.daily
+'''
+
+import json, sqlite3, threading, Queue
+from datetime import datetime, timedelta
+from cmapi.app import app
+from cmapi.sink import FactSink
+from cmapi.enrich import Enricher
+from cmapi.admission import Busy
+from cmapi import es, pipeline, processors
+
+class Checkpoint(object):
+    def __init__(self, path, retries=3):
+        self.path = path
+        self.retries = retries
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE IF NOT EXISTS done (cid TEXT PRIMARY KEY, status TEXT, finished TEXT, attempts INTEGER DEFAULT 1)')
+        try:
+            conn.execute('ALTER TABLE done ADD COLUMN attempts INTEGER DEFAULT 1')
+        except sqlite3.OperationalError:
+            pass
+        conn.close()
+
+    def _conn(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def high_water(self):
+        conn = self._conn()
+        row = conn.execute("SELECT value FROM state WHERE name = 'high_water'").fetchone()
+        conn.close()
+        return row[0] if row is not None else None
+
+    def advance(self, created_date):
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO state VALUES ('high_water', ?)", (created_date,))
+        conn.close()
+
+    def is_done(self, cid):
+        # done, or failed as many times as it is worth trying
+        conn = self._conn()
+        row = conn.execute('SELECT status, attempts FROM done WHERE cid = ?', (cid,)).fetchone()
+        conn.close()
+        return row is not None and (row[0] == 'done' or row[1] >= self.retries)
+
+    def done(self, cid, status='done'):
+        conn = self._conn()
+        row = conn.execute('SELECT attempts FROM done WHERE cid = ?', (cid,)).fetchone()
+        attempts = row[0] + 1 if row is not None and status != 'done' else 1
+        conn.execute('INSERT OR REPLACE INTO done VALUES (?,?,?,?)', (cid, status, datetime.now().strftime("%Y-%m-%d %H%M"), attempts))
+        conn.close()
+
+
+def pages(since, size):
+    # the daily catalogue records created since the given date, oldest first, a page at a time
+    # records sharing the created_date a page ended on are skipped past with from, the sort on _uid keeping
+    # their order the same from one query to the next
+    last = since
+    seen = 0
+    while True:
+        q = {
+            "query": {
+                "filtered": {
+                    "filter": {
+                        "bool": {
+                            "must": [
+                                {
+                                    "term": {
+                                        "tags.exact": "daily"
+                                    }
+                                },
+                                {
+                                    "range": {
+                                        "created_date": {
+                                            "gte":  last
+                                        }
                                     }
                                 }
-                            }
-                        ]
+                            ]
+                        }
                     }
                 }
-            }
-        },
-        "sort": [{"created_date": {"order":"desc"}}],
-        "fields": [],
-        "size": 1000000
-    }    
-    results = requests.post('http://localhost:9200/contentmine/catalogue/_search', data=json.dumps(q))
-
-    print "ready to proces " + str(result in results.json().get('hits',{}).get('total',0)) + ' records.'
-    for result in results.json().get('hits',{}).get('hits',[]):
-        print "processing " + str(result['_id'])
-        daily(result['_id'])
-
-        
-getdailies()
+            },
+            "sort": [{"created_date": {"order":"asc"}}, {"_uid": {"order":"asc"}}],
+            "_source": ["link","created_date"],
+            "from": seen,
+            "size": size
+        }
+        r = es.post(app.config['CATALOGUE_API'] + '_search', data=json.dumps(q)).json()
+        if 'hits' not in r:
+            raise Exception('The catalogue query failed: ' + json.dumps(r.get('error', r)))
+        if last == since and seen == 0:
+            print "ready to process " + str(r['hits'].get('total',0)) + ' records.'
+        if len(r['hits']['hits']) == 0:
+            return
+        page = [{"cid": h['_id'], "url": h['_source']['link'][0]['url'], "created_date": h['_source']['created_date']} for h in r['hits']['hits']]
+        yield page
+        if page[-1]['created_date'] == last:
+            seen += len(page)
+        else:
+            last = page[-1]['created_date']
+            seen = len([rec for rec in page if rec['created_date'] == last])
+
+
+def prepare(records, workers):
+    # fetch and normalise the articles, a few at a time - returns the cids that now have a scholarly.html
+    todo = Queue.Queue()
+    for rec in records: todo.put(rec)
+    ready = []
+    def work():
+        while True:
+            try:
+                rec = todo.get_nowait()
+            except Queue.Empty:
+                return
+            print "preparing " + rec['cid']
+            res = pipeline.Pipeline(app, cid=rec['cid'], url=rec['url'], stages=['fetch','norma']).run()
+            if res['stages'].get('norma',{}).get('status') in ['complete','skipped']:
+                ready.append(rec['cid'])
+    threads = [threading.Thread(target=work) for i in range(min(workers, len(records)))]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return ready
+
+
+def failed(res):
+    # the cids of a batch run that did not get through - those its results files could not be read for, or
+    # every cid of a batch whose command could not be run or was stopped at its timeout
+    out = set()
+    for b in res.get('batches',[]):
+        cids = b.get('cid',[])
+        if not isinstance(cids,list): cids = [cids]
+        for f in b.get('failures',[]):
+            if f.get('cid',None) is not None:
+                out.add(f['cid'])
+            else:
+                out.update(cids)
+        if b.get('output',None) == {} and len(b.get('errors',[])) > 0:
+            out.update(cids)
+    return out
+
+
+def extract(cids):
+    # run each ami2 processor over all the cids, in batches - returns the facts found for each cid, and the
+    # cids that any processor failed on
+    facts = {cid: [] for cid in cids}
+    bad = set()
+    if len(cids) == 0: return facts, bad
+    with app.app_context():
+        for pr in [processors.Amispecies, processors.Amiregex, processors.Amiidentifier]:
+            print "running " + pr.__name__.lower() + " on " + str(len(cids)) + " records"
+            try:
+                res = pr().run(cids=cids)
+            except Busy:
+                print pr.__name__.lower() + " is busy, leaving these records for the next run"
+                bad.update(cids)
+                continue
+            bad.update(failed(res))
+            for cid, found in res['results'].items():
+                for fact in found.get('facts',[]):
+                    fact['processor'] = pr.__name__.lower()
+                    facts[cid].append(fact)
+    return facts, bad
+
+
+def harvest(records, checkpoint, tags, enricher=None):
+    # take one page of catalogue records through to facts in the index
+    # a cid any processor failed on is recorded as failed without indexing its facts, so that trying it again
+    # does not index them twice - facts are given keywords by the enricher, if there is one
+    records = [rec for rec in records if not checkpoint.is_done(rec['cid'])]
+    ready = prepare(records, app.config['DAILY_WORKERS'])
+    facts, bad = extract(ready)
+    ok = [cid for cid in ready if cid not in bad]
+    if enricher is not None:
+        enricher.enrich([fact for cid in ok for fact in facts[cid]])
+    with FactSink(app.config['FACT_API'], size=app.config['BULK_SIZE'], interval=app.config['BULK_INTERVAL']) as fs:
+        for rec in records:
+            cid = rec['cid']
+            if cid in ok:
+                for fact in facts.get(cid,[]):
+                    fact['tags'] = tags
+                    fact['source'] = cid
+                    fs.add(fact)
+                # the facts of the cid must be indexed before it is recorded as done
+                fs.flush()
+            checkpoint.done(cid, 'done' if cid in ok else 'failed')
+    return fs.counts
+
+
+def daily(cid, tags=[]):
+    # harvest a single record of the catalogue
+    try:
+        rec = es.get(app.config['CATALOGUE_API'] + cid).json()['_source']
+    except:
+        return {"errors": "this ID does not exist in our catalogue"}
+    return harvest([{"cid": cid, "url": rec['link'][0]['url'], "created_date": rec.get('created_date')}], Checkpoint(app.config['DAILY_DB'], app.config['DAILY_RETRIES']), tags + ['daily', datetime.now().strftime("%Y%m%d")])
+
+
+def getdailies(getkeywords=False):
+    checkpoint = Checkpoint(app.config['DAILY_DB'], app.config['DAILY_RETRIES'])
+    since = checkpoint.high_water()
+    if since is None: since = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d %H%M")
+    print "getting dailies since ", since
+    tags = ['daily', datetime.now().strftime("%Y%m%d")]
+    # one enricher for the whole run, so its cache and rate limit carry over from page to page
+    enricher = Enricher(app.config) if getkeywords else None
+    # the high water mark is held at the first record still to be retried, so the next run gets back to it
+    hold = None
+    for page in pages(since, app.config['DAILY_PAGE']):
+        print "processing " + str(len(page)) + " records up to " + page[-1]['created_date']
+        print harvest(page, checkpoint, tags, enricher)
+        if hold is None:
+            pending = [rec for rec in page if not checkpoint.is_done(rec['cid'])]
+            if len(pending) > 0: hold = pending[0]['created_date']
+        checkpoint.advance(hold if hold is not None else page[-1]['created_date'])
+
+
+if __name__ == "__main__":
+    getdailies(app.config['DAILY_KEYWORDS'])
@@ -0,0 +1,64 @@
+
+'''
+Admission control for the commands run by processors
+Each processor may name a group (e.g. ami2) whose commands may only run ADMISSION_LIMITS[group] at a time,
+across all the app workers on the box. The slots are lock files in ADMISSION_DIR held with flock, so a slot is
+freed even if the worker holding it dies. A run that finds no free slot waits for one, but only up to
+ADMISSION_QUEUE runs of a group may wait at once, and none for longer than ADMISSION_TIMEOUT seconds - beyond
+that Busy is raised, which the app returns as a 429 with a Retry-After header.
+'''
+
+import os, time, fcntl
+
+class Busy(Exception):
+    def __init__(self, group, retry):
+        Exception.__init__(self, 'Too many ' + group + ' runs waiting, try again later.')
+        self.retry = retry
+
+
+def _take(path, count):
+    # lock the first free one of count lock files, returning its open file, or None if all are held
+    for i in range(count):
+        f = open(path + '.' + str(i) + '.lock', 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return f
+        except IOError:
+            f.close()
+    return None
+
+
+class Slot(object):
+    def __init__(self, group, config):
+        self.group = group
+        self.config = config
+        self.held = None
+
+    def __enter__(self):
+        limit = self.config['ADMISSION_LIMITS'].get(self.group, None) if self.group is not None else None
+        if limit is None:
+            return self
+        if not os.path.exists(self.config['ADMISSION_DIR']):
+            os.makedirs(self.config['ADMISSION_DIR'])
+        path = os.path.join(self.config['ADMISSION_DIR'], self.group)
+        self.held = _take(path + '.run', limit)
+        if self.held is not None:
+            return self
+        queued = _take(path + '.queue', self.config['ADMISSION_QUEUE'])
+        if queued is None:
+            raise Busy(self.group, self.config['ADMISSION_RETRY'])
+        try:
+            deadline = time.time() + self.config['ADMISSION_TIMEOUT']
+            while self.held is None:
+                if time.time() > deadline:
+                    raise Busy(self.group, self.config['ADMISSION_RETRY'])
+                time.sleep(self.config['ADMISSION_POLL'])
+                self.held = _take(path + '.run', limit)
+        finally:
+            queued.close()
+        return self
+
+    def __exit__(self, *args):
+        if self.held is not None:
+            self.held.close()
+            self.held = None
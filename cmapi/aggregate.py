@@ -0,0 +1,34 @@
+
+'''
+Collapses duplicate facts into one record each
+Amispecies runs its binomial, genus and genussp searches over the same text, so the same name in the same
+place comes back several times. Facts are grouped by fact, exact (or name) and a hash of their pre and post
+context, and each group becomes one record - the first fact of the group - with a count of how many there were
+and the offsets (the positions in the list given) that they came from. The records come back as Facts.
+The grouping is done over columns rather than fact by fact: the key column is built in one pass, the row
+numbers are sorted by it, and each run of equal keys is one group.
+'''
+
+import hashlib, itertools
+from cmapi.translator import Facts
+
+def context(pre, post):
+    return hashlib.sha1((pre or '').encode('utf-8') + '\x00' + (post or '').encode('utf-8')).hexdigest()
+
+def keys(facts):
+    # the grouping key of each fact, as a column
+    exact = [e or n for e, n in zip(facts.column('exact'), facts.column('name'))]
+    ctx = map(context, facts.column('pre'), facts.column('post'))
+    return zip(facts.column('fact'), exact, ctx)
+
+def aggregate(facts):
+    # the distinct facts, in the order each was first found, with count and offsets set on each
+    if not isinstance(facts, Facts): facts = Facts(facts)
+    key = keys(facts)
+    order = sorted(xrange(len(facts)), key=key.__getitem__)
+    groups = [list(rows) for k, rows in itertools.groupby(order, key=key.__getitem__)]
+    groups.sort(key=lambda rows: rows[0])
+    records = facts.take([rows[0] for rows in groups])
+    records.set('count', [len(rows) for rows in groups])
+    records.set('offsets', groups)
+    return records
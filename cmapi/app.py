@@ -1,13 +1,17 @@
 
-import os, requests, json, uuid, inspect
+# when this worker process started on the app, for the start time metric
+import time
+STARTED = time.time()
+
+import os, json, uuid, hashlib
 from functools import wraps
 from datetime import datetime
 
 from flask import Flask, request, make_response, current_app, abort, redirect
 from flask.ext.login import LoginManager, current_user, login_user
 
-from cmapi import settings, processors
-from cmapi.translator import Translator as translator
+from cmapi import settings, processors, registry, jobs, pipeline, sink, es, cache, admission, storage, metrics
+from cmapi.translator import Translator as translator, Facts, encode
 
 login_manager = LoginManager()
 
@@ -19,14 +23,30 @@ def create_app():
     config_path = os.path.join(os.path.dirname(here), 'app.cfg')
     if os.path.exists(config_path):
         app.config.from_pyfile(config_path)
+    # and then a config file named by CMAPI_SETTINGS, if set - cmapi/bench.py uses this to keep the app offline
+    app.config.from_envvar('CMAPI_SETTINGS', silent=True)
     login_manager.setup_app(app)
+    registry.load()
+    es.configure(app.config)
+    # the facts index is made once per box, not by every worker as it starts - see cmapi/es.py
+    # a worker still starts if it cannot be made, and the next one to start tries again
     if app.config.get('WITH_ES',False):
-        if requests.head(app.config['FACT_API']).status_code != 200:
-            requests.post(app.config['FACT_API'])
-            requests.put(app.config['MAPPING_URL'], json.dumps(app.config['MAPPING']))
+        try:
+            if app.config['ES_BOOTSTRAP'] == 'once':
+                es.bootstrap_once(app.config)
+            elif app.config['ES_BOOTSTRAP'] == 'worker':
+                es.bootstrap(app.config)
+        except Exception, e:
+            print 'could not make the facts index: ' + str(e)
     return app
 
 app = create_app()
+app.config['STARTUP_TIME'] = time.time() - STARTED
+if app.config.get('METRICS',False):
+    try:
+        metrics.Metrics(app.config['METRICS_DB']).record('app', {'start': app.config['STARTUP_TIME']})
+    except Exception, e:
+        print 'could not record the start time: ' + str(e)
 
 @login_manager.user_loader
 def load_account_for_login_manager(userid):
@@ -64,6 +84,13 @@ def page_not_found(e):
 @app.errorhandler(401)
 def page_not_found(e):
     return 'Unauthorised', 401
+
+@app.errorhandler(admission.Busy)
+def busy(e):
+    resp = make_response(json.dumps({"errors": [str(e)]}), 429)
+    resp.mimetype = "application/json"
+    resp.headers['Retry-After'] = str(e.retry)
+    return resp
         
         
 def rjson(f):
@@ -71,17 +98,58 @@ def rjson(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         callback = request.args.get('callback', False)
+        res = f(*args, **kwargs)
+        if isinstance(res, current_app.response_class): return res
         if callback:
-            content = str(callback) + '(' + str(f(*args,**kwargs)) + ')'
+            content = str(callback) + '(' + (json.dumps(res, sort_keys=True, default=encode) if isinstance(res,dict) or isinstance(res,list) else str(res)) + ')'
             return current_app.response_class(content, mimetype='application/javascript')
         else:
-            res = f(*args, **kwargs)
             if not isinstance(res,dict) and not isinstance(res,list): res = [i for i in str(res).split('\n') if len(i) > 0]
-            resp = make_response( json.dumps( res, sort_keys=True ) )
+            resp = make_response( json.dumps( res, sort_keys=True, default=encode ) )
             resp.mimetype = "application/json"
             return resp
     return decorated_function
 
+def formatted(res, fmt):
+    # processor output with its facts as columns (format=columnar), or as newline delimited JSON (format=ndjson)
+    # where the first line is the rest of the output and then each fact is a line, with its cid if it was a batch
+    results = res.get('results',{}) if isinstance(res.get('results',None),dict) else {}
+    if fmt == 'columnar':
+        if 'facts' in res: res['facts'] = Facts(res['facts']).columnar()
+        for r in results.values():
+            if 'facts' in r: r['facts'] = Facts(r['facts']).columnar()
+        return res
+    elif fmt == 'ndjson':
+        def content():
+            facts = res.pop('facts',[])
+            found = {cid: results[cid].pop('facts',[]) for cid in results}
+            yield json.dumps(res, sort_keys=True, default=encode) + '\n'
+            for fact in facts:
+                yield json.dumps(fact) + '\n'
+            for cid in found:
+                for fact in found[cid]:
+                    fact['cid'] = cid
+                    yield json.dumps(fact) + '\n'
+        return current_app.response_class(content(), mimetype='application/x-ndjson')
+    return res
+
+def cached(body):
+    # a JSON response that does not change, with an ETag so that clients can check it instead of fetching it again
+    if request.args.get('callback', False): return body
+    content = json.dumps(body, sort_keys=True, default=encode)
+    resp = make_response(content)
+    resp.mimetype = "application/json"
+    resp.set_etag(hashlib.sha1(content).hexdigest())
+    return resp.make_conditional(request)
+
+INDEX = {
+    "title": "ContentMine API",
+    "version": "0.2",
+    "README": "ContentMine can retrieve PDF, HTML, XML documents from URLs and store metadata about the articles contained in those documents, then it can normalise the documents and extract facts by processing the normalised document with more processors. Append a processor name from the list below to the API url to learn more about each available route. Extracted facts can be explored at the /fact route.",
+    "processors": registry.names(),
+    "routes": ["fact"]
+}
+
 # add checks once account auth in place    
 
 @app.route('/', methods=['GET','POST'])
@@ -90,22 +158,63 @@ def rjson(f):
 @rjson
 def proc(procname=None):
     if procname is None:
-        return {
-            "title": "ContentMine API",
-            "version": "0.2",
-            "README": "ContentMine can retrieve PDF, HTML, XML documents from URLs and store metadata about the articles contained in those documents, then it can normalise the documents and extract facts by processing the normalised document with more processors. Append a processor name from the list below to the API url to learn more about each available route. Extracted facts can be explored at the /fact route.",
-            "processors": [name.lower() for name, obj in inspect.getmembers(processors) if inspect.isclass(obj) and name != 'Processor'],
-            "routes": ["fact"]
-        }
-    elif request.path.endswith('meta'):
-        pr = getattr(processors, procname[0].capitalize() + procname[1:].lower() )
-        return pr().meta()
+        return cached(INDEX)
+    pr = registry.get(procname)
+    if pr is None: abort(404)
+    name = procname.lower()
+    if request.path.endswith('meta'):
+        return cached(registry.meta(name))
     else:
-        pr = getattr(processors, procname[0].capitalize() + procname[1:].lower() )
         params = request.json if request.json else request.values
         params = {k:params[k] for k in params.keys()}
-        return pr().run(**params)
+        if len([k for k in params.keys() if k not in ['callback','_']]) == 0:
+            return cached(registry.usage(name))
+        fmt = params.pop('format', None)
+        if str(params.pop('async', '')).lower() in ['true','1','yes']:
+            jid = jobs.JobQueue(app.config['JOBS_DB']).submit(name, params)
+            return {"job": jid, "status": "queued", "url": "/job/" + jid}
+        return formatted(pr().run(**params), fmt)
     
+
+# check on processor runs that were queued with async=true ---------------------
+@app.route('/job/<jid>')
+@rjson
+def job(jid):
+    j = jobs.JobQueue(app.config['JOBS_DB']).get(jid)
+    if j is None: abort(404)
+    del j['result']
+    return j
+
+@app.route('/job/<jid>/result')
+@rjson
+def jobresult(jid):
+    j = jobs.JobQueue(app.config['JOBS_DB']).get(jid)
+    if j is None or j['status'] not in ['done','failed']: abort(404)
+    return j['result']
+    
+    
+
+@app.route('/store/<cid>')
+@rjson
+def stored(cid):
+    # the files stored for a cid, from its manifest
+    st = storage.store(app.config)
+    manifest = st.manifest(cid)
+    if len(manifest) == 0: abort(404)
+    return {"cid": cid, "files": [dict(manifest[name], name=name, url=st.url(cid, name)) for name in sorted(manifest.keys())]}
+
+
+@app.route('/metrics')
+def processormetrics():
+    if not app.config.get('METRICS',False): abort(404)
+    return current_app.response_class(metrics.Metrics(app.config['METRICS_DB']).render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/cache')
+@rjson
+def cachestats():
+    if not app.config.get('CACHE',False): abort(404)
+    return cache.ResultCache(app.config['CACHE_DB'], app.config['CACHE_MAX_SIZE'], app.config['CACHE_MAX_AGE']).stats()
     
     
 # provide access to facts ------------------------------------------------------
@@ -115,7 +224,7 @@ def proc(procname=None):
 def factdirect(ident=None):
     if ident is not None:
         try:
-            f = requests.get(app.config['FACT_API'] + ident)
+            f = es.get(app.config['FACT_API'] + ident)
             rec = f.json()['_source']
         except:
             abort(404)
@@ -146,19 +255,53 @@ def factdirect(ident=None):
         if 'created_date' not in rec:
             rec['created_date'] = datetime.now().strftime("%Y-%m-%d %H%M")
         # TODO: save user doing this action
-        return requests.post(app.config['FACT_API'] + rec['id'], data=json.dumps(rec))
+        return es.post(app.config['FACT_API'] + rec['id'], data=json.dumps(rec))
 
 
 @app.route('/fact/query', methods=['GET','POST'])
-@rjson
 def fquery():
-    # NOTE tried streaming response with context here through requests but it was very slow
+    # the ES response is passed straight through in chunks, without being parsed and serialised again
+    # (streaming was once tried here and was very slow, as iter_content reads one byte at a time by default)
+    callback = request.args.get('callback', False)
     if request.method == 'GET':
-        return requests.get(app.config['FACT_API'] + '_search?' + "&".join([k + '=' + request.args[k] for k in request.args.keys()])).json()
+        args = [k + '=' + request.args[k] for k in request.args.keys() if k not in ['callback','_']]
+        r = es.get(app.config['FACT_API'] + '_search?' + "&".join(args), stream=True)
     elif request.method == 'POST':
         params = request.json if request.json else request.values
         params = {k:params[k] for k in params.keys()}
-        return requests.post(app.config['FACT_API'] + '_search', data=json.dumps(params)).json()
+        r = es.post(app.config['FACT_API'] + '_search', data=json.dumps(params), stream=True)
+    def content():
+        if callback: yield str(callback) + '('
+        for chunk in r.iter_content(app.config['STREAM_CHUNK']):
+            yield chunk
+        if callback: yield ')'
+    return current_app.response_class(content(), status=r.status_code, mimetype='application/javascript' if callback else 'application/json')
+
+
+@app.route('/fact/export', methods=['GET','POST'])
+def fexport():
+    # every fact matching the query as newline delimited JSON, paged out of ES with the scroll API
+    # so that any number of facts can be pulled without holding them all in memory
+    params = request.json if request.json else request.values
+    if 'query' in params:
+        qry = {'query': params['query'] if isinstance(params['query'],dict) else json.loads(params['query'])}
+    elif 'q' in params:
+        qry = {'query': {'query_string': {'query': params['q']}}}
+    else:
+        qry = {'query': {'match_all': {}}}
+    qry['size'] = app.config['EXPORT_SIZE']
+    scroll = app.config['EXPORT_SCROLL']
+    host = app.config['ES_HOST']
+    r = es.post(app.config['FACT_API'] + '_search?scroll=' + scroll, data=json.dumps(qry)).json()
+    def content(r):
+        try:
+            while len(r.get('hits',{}).get('hits',[])) > 0:
+                for hit in r['hits']['hits']:
+                    yield json.dumps(hit['_source']) + '\n'
+                r = es.get(host + '_search/scroll', params={'scroll': scroll, 'scroll_id': r['_scroll_id']}).json()
+        finally:
+            if '_scroll_id' in r: es.delete(host + '_search/scroll', params={'scroll_id': r['_scroll_id']})
+    return current_app.response_class(content(r), mimetype='application/x-ndjson')
     
 
 @app.route('/fact/daily')
@@ -175,7 +318,7 @@ def factdaily():
         },
         'sort': [{"created_date.exact":{"order":"desc"}}]
     }
-    r = requests.post(app.config['FACT_API'] + '_search', data=json.dumps(qry))
+    r = es.post(app.config['FACT_API'] + '_search', data=json.dumps(qry))
     # TODO: decide if any control keys should be removed before displaying facts
     return [i['_source'] for i in r.json().get('hits',{}).get('hits',[])]
     
@@ -183,27 +326,27 @@ def factdaily():
     
 
 
-@app.route('/processit')
+@app.route('/processit', methods=['GET','POST'])
 @rjson
 def processit():
-    if url:
-        pass
-    elif urls:
-        pass
-    elif cid:
-        pass
-    elif cids:
-        pass
-    elif query:
-        pass
-    # check each url in the catalogue
-    # check each id in the catalogue
-    # or if a query get the list of IDs from that query
-    # if already there, look to see if we have files on disk for them
-    # if not on disk try to retrieve them either directly or with quickscrape
-    # if not on disk try to retrieve them either directly or with quickscrape
-    # otherwise just grab what is at the url directly
-    # run the rest of the specified plugins
+    # fetch, normalise and extract facts from one article in a single call
+    # the article is identified by cid if it is already on disk, otherwise it is fetched from url
+    # stages whose output is already on disk are skipped unless force=true
+    params = request.json if request.json else request.values
+    if not params.get('cid',False) and not params.get('url',False):
+        return {"usage": "Provide a cid of an article already on disk, or a url to fetch it from, and optionally force=true to rerun stages whose output already exists, and stages=norma,amispecies to run only some stages."}
+    stages = params.get('stages',None)
+    if stages is not None:
+        if not isinstance(stages,list): stages = stages.split(',')
+        stages = [s for s in stages if s in pipeline.STAGES]
+    p = pipeline.Pipeline(
+        current_app._get_current_object(), 
+        cid=params.get('cid',None), 
+        url=params.get('url',None), 
+        force=str(params.get('force','')).lower() in ['true','1','yes'],
+        stages=stages
+    )
+    return p.run()
     
 
 # queue up article metadata records that need processing -----------------------
@@ -278,11 +421,13 @@ def receive(processor=None,tag=None):
             try:
                 fl = request.files['file']
                 t = translator(processor=processor)
-                results = t.translate(fl)
-                for res in results:
-                    res['set'] = tag
-                    res['processor'] = processor
-                    requests.post('http://contentmine.org/api/fact', data=json.dumps(res))
+                with sink.FactSink(app.config['FACT_API'], size=app.config['BULK_SIZE'], interval=app.config['BULK_INTERVAL']) as fs:
+                    for chunk in t.chunks(fl, app.config['TRANSLATE_CHUNK']):
+                        for res in chunk:
+                            res['set'] = tag
+                            res['processor'] = processor
+                            fs.add(res)
+                return fs.counts
             except:
                 abort(404)
     else:
@@ -0,0 +1,254 @@
+
+'''
+Benchmarks of the translator, processor and response paths, run offline
+Stub quickscrape, norma and ami2 executables are written to a temp dir, and the ami2 stubs copy a synthetic
+results.xml of the size being measured into the -q dirs they are given, so no real tools or network are needed.
+The app is made with a config (passed in CMAPI_SETTINGS) that turns ES, caching and metrics off and puts every
+db and dir it uses in the temp dir.
+Measured, for each size of results file:
+translate.<processor>.<size> - Translator.translate of a results file with that many results
+facts.<processor>.<size> - Translator.facts of the same file
+run.<processor>.<size> - a whole Processor.run on one cid with the stub tool - quickscrape and norma are
+measured once, as run.quickscrape and run.norma, as what they do does not depend on size
+child.<processor>.<size> - the stub tool alone, run by spawn as run would run it
+overhead.<processor>.<size> - run less child, the time the API adds around the tool
+rjson.<size> - an rjson response of a processor output with that many facts
+txt2html.<size> - the Retrieve conversion of a text file of size lines
+Each is the best of --repeat runs, in seconds. The results are printed as JSON, and with --save are also
+written to a file, which a later run can be compared against with --baseline - the comparison is printed
+to stderr, and the exit code is 1 if anything is slower than the baseline by more than --tolerance.
+python -m cmapi.bench --sizes 1000,10000,100000,1000000 --save baseline.json
+python -m cmapi.bench --baseline baseline.json > bench_output.txt
+'''
+
+import os, sys, json, time, shutil, tempfile, argparse, platform, timeit
+from cmapi.translator import Translator
+from cmapi.convert import txt2html
+from cmapi.spawn import spawn
+
+# the attributes of a result element of each processor, as the ami2 tools write them
+RESULTS = {
+    'amispecies': 'pre="was found in the leaves of " exact="Quercus robur" match="Quercus robur" post=" growing in the wet woodland at" name="binomial"',
+    'amiidentifier': 'pre="the accession number is " exact="GSE%d" post=" and the sequences were deposited"',
+    'amiregex': 'pre="the samples were incubated at " value0="%d degrees" post=" for twelve hours before"'
+}
+
+# where the processor looks for the results of each ami2 tool, under each -q dir
+OUTPUTS = {
+    'ami2-species': ['results/species/' + tp + '/results.xml' for tp in ['binomial','genus','genussp']],
+    'ami2-identifier': ['results/identifier/results.xml'],
+    'ami2-regex': ['results/regex/concatenated/results.xml']
+}
+
+def results_file(path, processor, size):
+    # a synthetic results.xml of size results - the number is put into some of them so that not all are the same
+    attrs = RESULTS[processor]
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<results title="bench">\n')
+        for i in xrange(size):
+            f.write('<result ' + (attrs % (i % 97) if '%d' in attrs else attrs) + '/>\n')
+        f.write('</results>\n')
+    return path
+
+def text_file(path, size):
+    # a plain text file of size lines, in paragraphs of ten lines
+    with open(path, 'w') as f:
+        for i in xrange(size):
+            f.write('this is line %d of the text of an article that only came as a pdf\n' % i)
+            if i % 10 == 9: f.write('\n')
+    return path
+
+
+def stub(name, args):
+    # what the stub tools do - write the files the processors expect, and say so
+    dirs = []
+    if '-q' in args:
+        for a in args[args.index('-q')+1:]:
+            if a.startswith('-'): break
+            dirs.append(a)
+    if name == 'quickscrape':
+        url = args[args.index('--url')+1] if '--url' in args else args[args.index('-u')+1]
+        out = os.path.join(args[args.index('--output')+1], url.replace('://','_').replace('/','_').replace(':',''))
+        if not os.path.exists(out): os.makedirs(out)
+        with open(os.path.join(out, 'fulltext.html'), 'w') as f: f.write('<html><body><p>bench</p></body></html>')
+    elif name == 'norma':
+        for d in dirs:
+            with open(os.path.join(d, 'scholarly.html'), 'w') as f: f.write('<html><body><p>bench</p></body></html>')
+    else:
+        for d in dirs:
+            for o in OUTPUTS[name]:
+                dst = os.path.join(d, o)
+                if not os.path.exists(os.path.dirname(dst)): os.makedirs(os.path.dirname(dst))
+                if os.path.exists(dst): os.remove(dst)
+                shutil.copy(os.environ['BENCH_RESULTS'], dst)
+    print name + ' wrote ' + str(len(dirs)) + ' dirs'
+
+def stubs(bindir):
+    # executables that run stub under each tool name
+    for name in ['quickscrape', 'norma'] + OUTPUTS.keys():
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nPYTHONPATH="' + os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + '" exec "' + sys.executable + '" -m cmapi.bench --stub ' + name + ' "$@"\n')
+        os.chmod(path, 0755)
+
+
+def best(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        fn()
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+def bench_translate(tmp, sizes, repeat):
+    res = {}
+    for processor in RESULTS.keys():
+        for size in sizes:
+            fl = results_file(os.path.join(tmp, processor + '.' + str(size) + '.xml'), processor, size)
+            res['translate.' + processor + '.' + str(size)] = best(lambda: Translator(processor).translate(fl), repeat)
+            res['facts.' + processor + '.' + str(size)] = best(lambda: Translator(processor).facts(fl), repeat)
+            os.remove(fl)
+    return res
+
+def offline(tmp):
+    # a config for the app that keeps everything it does within tmp and off the network
+    cfg = os.path.join(tmp, 'bench.cfg')
+    dirs = ['STORAGE_DIR', 'ADMISSION_DIR', 'QS_TMP_DIR', 'QS_JS_DIR', 'REGEXES_DIR', 'REGEXES_CACHE_DIR', 'ES_BOOTSTRAP_DIR']
+    dbs = ['JOBS_DB', 'CACHE_DB', 'METRICS_DB', 'DAILY_DB', 'KEYWORDS_CACHE_DB']
+    with open(cfg, 'w') as f:
+        f.write('WITH_ES = False\nCACHE = False\nENGINE = False\nMETRICS = False\n')
+        for name in dirs:
+            f.write(name + ' = ' + repr(os.path.join(tmp, name.lower()) + '/') + '\n')
+        for name in dbs:
+            f.write(name + ' = ' + repr(os.path.join(tmp, name.lower() + '.db')) + '\n')
+    os.environ['CMAPI_SETTINGS'] = cfg
+
+def stubbed(pr, bindir):
+    # the processor as it is, but running the stub of its tool
+    class Stubbed(pr):
+        def _cmd(self, **kwargs):
+            pr._cmd(self, **kwargs)
+            self.output['command'][0] = os.path.join(bindir, os.path.basename(self.output['command'][0]))
+    Stubbed.__name__ = pr.__name__
+    return Stubbed
+
+def timed(res, name, run, child):
+    res['run.' + name] = run
+    res['child.' + name] = child
+    res['overhead.' + name] = max(0, run - child)
+
+def bench_run(tmp, sizes, repeat):
+    from cmapi.app import app
+    from cmapi import processors, storage
+    bindir = os.path.join(tmp, 'bin')
+    os.makedirs(bindir)
+    stubs(bindir)
+    res = {}
+    with app.app_context():
+        st = storage.store(app.config)
+        # quickscrape of a url, then norma of the fulltext.xml of a cid
+        qs = stubbed(processors.Quickscrape, bindir)
+        run = best(lambda: qs().run(url='http://example.org/bench', cid='benchquickscrape'), repeat)
+        p = qs()
+        p._cmd(url='http://example.org/bench')
+        timed(res, 'quickscrape', run, best(lambda: spawn(p.output['command']), repeat))
+        cid = 'benchnorma'
+        if not os.path.exists(st.dir(cid)): os.makedirs(st.dir(cid))
+        with open(st.path(cid, 'fulltext.xml'), 'w') as f: f.write('<article><body><p>bench</p></body></article>')
+        norma = stubbed(processors.Norma, bindir)
+        run = best(lambda: norma().run(cid=cid), repeat)
+        p = norma()
+        p._cmd(cid=cid)
+        timed(res, 'norma', run, best(lambda: spawn(p.output['command']), repeat))
+        # the ami2 processors over results files of each size
+        for processor in ['amispecies', 'amiidentifier', 'amiregex']:
+            pr = stubbed(getattr(processors, processor.capitalize()), bindir)
+            for size in sizes:
+                os.environ['BENCH_RESULTS'] = results_file(os.path.join(tmp, 'results.xml'), processor, size)
+                cid = 'bench' + processor + str(size)
+                if not os.path.exists(st.dir(cid)): os.makedirs(st.dir(cid))
+                with open(st.path(cid, 'scholarly.html'), 'w') as f: f.write('<html><body><p>bench</p></body></html>')
+                run = best(lambda: pr().run(cid=cid, cache=False), repeat)
+                p = pr()
+                p._cmd(cid=cid)
+                timed(res, processor + '.' + str(size), run, best(lambda: spawn(p.output['command']), repeat))
+    return res
+
+def bench_rjson(tmp, sizes, repeat):
+    from cmapi.app import app, rjson
+    res = {}
+    for size in sizes:
+        fl = results_file(os.path.join(tmp, 'rjson.xml'), 'amispecies', size)
+        output = {"command": ["/usr/bin/ami2-species"], "cid": "bench", "errors": [], "output": [], "facts": Translator('amispecies').facts(fl)}
+        output['factcount'] = len(output['facts'])
+        respond = rjson(lambda: output)
+        with app.test_request_context('/amispecies'):
+            res['rjson.' + str(size)] = best(respond, repeat)
+        os.remove(fl)
+    return res
+
+def bench_txt2html(tmp, sizes, repeat):
+    res = {}
+    for size in sizes:
+        src = text_file(os.path.join(tmp, 'unpdf.txt'), size)
+        res['txt2html.' + str(size)] = best(lambda: txt2html(src, os.path.join(tmp, 'fulltext.html')), repeat)
+    return res
+
+BENCHMARKS = {
+    'translate': bench_translate,
+    'run': bench_run,
+    'rjson': bench_rjson,
+    'txt2html': bench_txt2html
+}
+
+
+def compare(results, baseline, tolerance):
+    # the ratio of each result to the baseline, and the names of those slower than it by more than tolerance
+    ratios = {}
+    slower = []
+    for name in sorted(results.keys()):
+        if name in baseline and baseline[name] > 0:
+            ratios[name] = results[name] / baseline[name]
+            if ratios[name] > 1 + tolerance: slower.append(name)
+    return ratios, slower
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks of cmapi, run offline against stub tools.')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma-separated numbers of results')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', default=','.join(sorted(BENCHMARKS.keys())), help='comma-separated benchmarks to run')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare the results to those saved in this file')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--stub', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.stub is not None:
+        return stub(args.stub[0], args.stub[1:])
+    sizes = [int(s) for s in args.sizes.split(',') if len(s) > 0]
+    tmp = tempfile.mkdtemp(prefix='cmapi-bench-')
+    offline(tmp)
+    results = {}
+    try:
+        for name in args.only.split(','):
+            results.update(BENCHMARKS[name](tmp, sizes, args.repeat))
+    finally:
+        shutil.rmtree(tmp)
+    out = {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(), "date": time.strftime("%Y-%m-%d %H%M"), "sizes": sizes, "repeat": args.repeat},
+        "results": results
+    }
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            ratios, slower = compare(results, json.load(f)['results'], args.tolerance)
+        out['baseline'] = {"file": args.baseline, "ratios": ratios, "slower": slower}
+        for name in sorted(ratios.keys()):
+            sys.stderr.write('%-40s %8.4fs %6.2fx%s\n' % (name, results[name], ratios[name], ' SLOWER' if name in slower else ''))
+    print json.dumps(out, sort_keys=True, indent=2)
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(out, f, sort_keys=True, indent=2)
+    return 1 if args.baseline is not None and len(out['baseline']['slower']) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,75 @@
+
+'''
+A cache of processor run results
+Results are keyed by the processor, the command built for the run by _cmd, and a digest of the content of the
+input files the processor reads from the storage dirs of the cids being processed - so a changed input is a miss.
+Entries are kept in a SQLite database shared by all the workers. They expire after max_age seconds, and the least
+recently used are evicted once the stored results add up to more than max_size bytes.
+Hit and miss counts are kept alongside, and can be seen at /cache.
+'''
+
+import sqlite3, json, hashlib, os, time
+from cmapi.translator import encode
+
+class ResultCache(object):
+    def __init__(self, path, max_size, max_age):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, size INTEGER, created REAL, accessed REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+        conn.execute("INSERT OR IGNORE INTO stats VALUES ('hits', 0)")
+        conn.execute("INSERT OR IGNORE INTO stats VALUES ('misses', 0)")
+        conn.close()
+
+    def _conn(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def key(self, processor, command, dirs, inputs):
+        # returns None if none of the input files exist, as there is then nothing to key the result on
+        h = hashlib.sha1(processor + '\n' + json.dumps(command))
+        found = False
+        for dr in dirs:
+            for fn in inputs:
+                fl = os.path.join(dr, fn)
+                if os.path.exists(fl):
+                    found = True
+                    h.update(fl)
+                    with open(fl, 'rb') as f:
+                        for block in iter(lambda: f.read(65536), ''):
+                            h.update(block)
+        return h.hexdigest() if found else None
+
+    def get(self, key):
+        conn = self._conn()
+        row = conn.execute('SELECT value FROM results WHERE key = ? AND created > ?', (key, time.time() - self.max_age)).fetchone()
+        if row is not None:
+            conn.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+        conn.execute('UPDATE stats SET value = value + 1 WHERE name = ?', ('hits' if row is not None else 'misses',))
+        conn.close()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, key, value):
+        value = json.dumps(value, default=encode)
+        conn = self._conn()
+        conn.execute('INSERT OR REPLACE INTO results VALUES (?,?,?,?,?)', (key, value, len(value), time.time(), time.time()))
+        self.evict(conn)
+        conn.close()
+
+    def evict(self, conn):
+        conn.execute('DELETE FROM results WHERE created <= ?', (time.time() - self.max_age,))
+        total = conn.execute('SELECT SUM(size) FROM results').fetchone()[0] or 0
+        if total > self.max_size:
+            for key, size in conn.execute('SELECT key, size FROM results ORDER BY accessed').fetchall():
+                conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                total -= size
+                if total <= self.max_size: break
+
+    def stats(self):
+        conn = self._conn()
+        res = {name: value for name, value in conn.execute('SELECT name, value FROM stats').fetchall()}
+        res['entries'], res['size'] = conn.execute('SELECT COUNT(*), SUM(size) FROM results').fetchone()
+        conn.close()
+        if res['size'] is None: res['size'] = 0
+        return res
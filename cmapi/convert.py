@@ -0,0 +1,34 @@
+
+'''
+Conversion of plain text to simple HTML, for documents that only have text (e.g. the text of a PDF)
+Blank lines separate paragraphs. The HTML is written out as the text is read, so the document is never held in memory.
+Conversions run in the process that asks for them, but only ADMISSION_LIMITS['convert'] at a time across all
+the workers on the box, so that a few huge documents cannot take all the CPU of the box.
+'''
+
+import os
+from cmapi.admission import Slot
+
+def txt2html(src, dst):
+    with open(src, 'r') as content:
+        with open(dst + '.part', 'w') as out:
+            out.write('<html><head></head><body><p>')
+            outofpara = False
+            for line in content:
+                if len(line.strip()) == 0:
+                    if not outofpara:
+                        out.write('</p>\n\n')
+                        outofpara = True
+                else:
+                    if outofpara:
+                        out.write('<p>')
+                        outofpara = False
+                    out.write(line.rstrip('\n'))
+            out.write('</p></body></html>')
+    os.rename(dst + '.part', dst)
+    return dst
+
+def convert(src, dst, config):
+    # waits for a convert slot, raising Busy like a processor's command if there is none to be had
+    with Slot('convert', config):
+        return txt2html(src, dst)
@@ -0,0 +1,44 @@
+
+'''
+Downloads files for the Retrieve processor in-process
+Each worker process keeps one pooled keep-alive requests Session for downloads, and responses are streamed to
+disk in chunks rather than read into memory. The file is written under a .part name and renamed once complete,
+so a failed download never leaves a partial file under the real name, and the .part file is removed.
+'''
+
+import os, requests
+from requests.adapters import HTTPAdapter
+
+_session = None
+_pid = None
+
+def session(size):
+    global _session, _pid
+    if _session is None or _pid != os.getpid():
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=size)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        _pid = os.getpid()
+    return _session
+
+def download(url, path, size=10, timeout=60, chunk=65536):
+    r = session(size).get(url, stream=True, timeout=timeout)
+    r.raise_for_status()
+    part = path + '.part'
+    try:
+        written = 0
+        with open(part, 'wb') as f:
+            for block in r.iter_content(chunk):
+                f.write(block)
+                written += len(block)
+        # a connection dropped part way through just ends the body, so it is checked against its length
+        length = r.headers.get('content-length', None)
+        if length is not None and 'content-encoding' not in r.headers and written != int(length):
+            raise IOError('The download of ' + url + ' was cut short at ' + str(written) + ' of ' + length + ' bytes.')
+        os.rename(part, path)
+    except:
+        # no partial file is left behind under either name
+        if os.path.exists(part): os.remove(part)
+        raise
+    return r.headers.get('content-type','')
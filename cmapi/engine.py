@@ -0,0 +1,189 @@
+
+'''
+An engine of long-lived worker processes for the norma and ami2 tools
+Starting a JVM for every run costs more than the extraction itself on most papers, so when ENGINE is on the
+processors send their commands to this engine instead of starting the tool themselves.
+Run the engine with python -m cmapi.engine (see deploy/cmapi.conf). It listens on the unix socket ENGINE_SOCKET,
+and keeps ENGINE_WORKERS worker processes for each tool in ENGINE_TOOLS, which maps the command a processor
+would run (e.g. /usr/bin/ami2-species) to the command that starts a long-lived worker for that tool.
+A worker is restarted once it has done ENGINE_MAX_JOBS jobs, or its resident memory is over ENGINE_MAX_MEMORY kB.
+Each job carries the timeout of the processor's PROCESS_LIMITS, which covers both the wait for a free worker and
+the run itself. A worker that has not answered by then is killed along with anything it started, and replaced.
+Only the last tail lines of the output and errors of a job are sent back, as spawn does. Unlike a command run by
+spawn, an engine job is not held to the cpu and memory of PROCESS_LIMITS - a worker is a shared long-lived
+process, bounded only by ENGINE_MAX_MEMORY and the timeout - and its full output is not logged to the logs dir
+of the cid, so runs through the engine have no logs urls.
+If the engine is off, or cannot be reached, or has no workers for a tool, or goes away part way through a job,
+processors start the tool as usual.
+
+A worker reads one job per line on stdin, as JSON like {"args": ["-q", "/dir", ...]} - the command line
+arguments a run of the tool would get - and writes one JSON line back on stdout with the exit code, output
+and errors of the run, like {"code": 0, "output": "...", "errors": "..."}. Anything else the tool prints must
+be kept off stdout. The clients of the engine talk the same protocol over the socket, adding the tool to the job.
+python -m cmapi.engine worker runs a stub worker that just runs each job as a subprocess, for trying it out.
+'''
+
+import os, sys, time, json, signal, select, socket, subprocess, threading, Queue, SocketServer
+
+def _tail(text, tail):
+    return ''.join(text.splitlines(True)[-tail:]) if tail is not None and isinstance(text, basestring) else text
+
+def timedout(timeout):
+    return {"code": -signal.SIGKILL, "output": "", "errors": "Engine job was stopped after running for " + str(timeout) + " seconds.", "timedout": True}
+
+
+class Worker(object):
+    def __init__(self, command, max_jobs, max_memory):
+        self.command = command
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.start()
+
+    def start(self):
+        # in its own process group, so that a hung worker can be killed with whatever it started
+        self.p = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, preexec_fn=os.setsid)
+        self.jobs = 0
+
+    def stop(self):
+        try:
+            self.p.stdin.close()
+            self.p.wait()
+        except:
+            self.kill()
+
+    def kill(self):
+        try:
+            os.killpg(self.p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.p.wait()
+
+    def _readline(self, deadline):
+        # one line of the worker's stdout, or None if it has not written one by the deadline
+        buf = ''
+        fd = self.p.stdout.fileno()
+        while not buf.endswith('\n'):
+            wait = deadline - time.time() if deadline is not None else None
+            if wait is not None and wait <= 0: return None
+            if len(select.select([fd], [], [], wait)[0]) == 0: return None
+            chunk = os.read(fd, 65536)
+            if chunk == '': raise IOError('worker closed its output')
+            buf += chunk
+        return buf
+
+    def memory(self):
+        # resident memory of the worker in kB, from /proc
+        try:
+            for line in open('/proc/' + str(self.p.pid) + '/status'):
+                if line.startswith('VmRSS:'): return int(line.split()[1])
+        except:
+            pass
+        return 0
+
+    def run(self, args, deadline=None, timeout=None, tail=None):
+        if self.p.poll() is not None: self.start()
+        try:
+            self.p.stdin.write(json.dumps({"args": args}) + '\n')
+            self.p.stdin.flush()
+            line = self._readline(deadline)
+            if line is None:
+                self.kill()
+                self.start()
+                return timedout(timeout)
+            res = json.loads(line)
+            res['output'], res['errors'] = _tail(res.get('output',''), tail), _tail(res.get('errors',''), tail)
+        except Exception, e:
+            # the worker died part way through the job, so it is replaced for the next one
+            self.stop()
+            self.start()
+            return {"code": 1, "output": "", "errors": "Engine worker failed: " + str(e)}
+        self.jobs += 1
+        if self.jobs >= self.max_jobs or self.memory() > self.max_memory:
+            self.stop()
+            self.start()
+        return res
+
+
+class Engine(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, tools, workers, max_jobs, max_memory):
+        if os.path.exists(path): os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, Handler)
+        # the idle workers of each tool - a job waits here until one of them is free
+        self.idle = {}
+        for tool, command in tools.items():
+            self.idle[tool] = Queue.Queue()
+            for i in range(workers):
+                self.idle[tool].put(Worker(command, max_jobs, max_memory))
+
+
+class Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        job = json.loads(self.rfile.readline())
+        timeout = job.get('timeout', None)
+        deadline = time.time() + timeout if timeout is not None else None
+        if job.get('tool') not in self.server.idle:
+            res = {"code": None, "output": "", "errors": "No engine workers for " + str(job.get('tool'))}
+        else:
+            try:
+                worker = self.server.idle[job['tool']].get(timeout=timeout)
+            except Queue.Empty:
+                worker = None
+                res = timedout(timeout)
+            if worker is not None:
+                try:
+                    res = worker.run(job['args'], deadline, timeout, job.get('tail', None))
+                finally:
+                    self.server.idle[job['tool']].put(worker)
+        self.wfile.write(json.dumps(res) + '\n')
+
+
+def execute(path, command, timeout=None, tail=None, grace=10):
+    # send a command to the engine - returns None if the engine cannot run it, so the caller should run it itself
+    # the engine stops the job at timeout, and the socket is given up on grace seconds after that
+    try:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(grace)
+        s.connect(path)
+    except socket.error:
+        return None
+    try:
+        s.settimeout(timeout + grace if timeout is not None else None)
+        f = s.makefile('rw')
+        f.write(json.dumps({"tool": command[0], "args": command[1:], "timeout": timeout, "tail": tail}) + '\n')
+        f.flush()
+        res = json.loads(f.readline())
+    except socket.timeout:
+        res = timedout(timeout)
+    except (socket.error, ValueError):
+        # the engine went away part way through, so no line, or not a whole one, came back
+        return None
+    finally:
+        s.close()
+    return res if res.get('code') is not None else None
+
+
+def worker():
+    # a stub worker that runs each job as a subprocess of the tool named by STUB_TOOL
+    tool = os.environ.get('STUB_TOOL', 'echo')
+    for line in iter(sys.stdin.readline, ''):
+        job = json.loads(line)
+        p = subprocess.Popen([tool] + job['args'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        sys.stdout.write(json.dumps({"code": p.returncode, "output": out, "errors": err}) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        worker()
+    else:
+        from cmapi.app import app
+        Engine(
+            app.config['ENGINE_SOCKET'],
+            app.config['ENGINE_TOOLS'],
+            app.config['ENGINE_WORKERS'],
+            app.config['ENGINE_MAX_JOBS'],
+            app.config['ENGINE_MAX_MEMORY']
+        ).serve_forever()
@@ -0,0 +1,136 @@
+
+'''
+Keyword enrichment of facts by the keyword parser service at KEYWORDS_API
+The blurb of a fact is its pre, fact and post text. The same blurbs come up again and again (species names
+repeat across thousands of facts), so each distinct blurb is only looked up once per call to enrich, and the
+keywords found are kept in an in-memory LRU cache of KEYWORDS_CACHE_SIZE blurbs backed by a SQLite cache in
+KEYWORDS_CACHE_DB, keyed by a hash of the blurb.
+Blurbs that are not cached are looked up one at a time with the parser's GET ?blurb= form. A parser that also
+takes a JSON POST of {"blurbs": [...]}, answering with a list of keywords for each in order, can be sent them
+KEYWORDS_BATCH at a time instead by setting that above 1. Calls are limited to KEYWORDS_RATE a second by a token
+bucket, and each gives up after KEYWORDS_TIMEOUT seconds.
+python -m cmapi.enrich runs a stub parser on port 5112 that answers both forms, for trying it out.
+'''
+
+import json, time, hashlib, sqlite3, threading, collections, requests
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        # wait until a token is free, then use it
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.last = time.time()
+                self.tokens = 0
+            else:
+                self.tokens -= 1
+
+
+class KeywordCache(object):
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.memory = collections.OrderedDict()
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS keywords (key TEXT PRIMARY KEY, value TEXT)')
+        conn.close()
+
+    def _conn(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        if len(self.memory) > self.size: self.memory.popitem(last=False)
+
+    def get(self, keys):
+        # the cached keywords of those keys that have them
+        found = {}
+        missing = []
+        for key in keys:
+            if key in self.memory:
+                found[key] = self.memory.pop(key)
+                self.memory[key] = found[key]
+            else:
+                missing.append(key)
+        if len(missing) > 0:
+            conn = self._conn()
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i+500]
+                for key, value in conn.execute('SELECT key, value FROM keywords WHERE key IN (' + ','.join(['?'] * len(chunk)) + ')', chunk).fetchall():
+                    found[key] = json.loads(value)
+                    self._remember(key, found[key])
+            conn.close()
+        return found
+
+    def put(self, values):
+        conn = self._conn()
+        conn.executemany('INSERT OR REPLACE INTO keywords VALUES (?,?)', [(key, json.dumps(value)) for key, value in values.items()])
+        conn.close()
+        for key, value in values.items(): self._remember(key, value)
+
+
+class Enricher(object):
+    def __init__(self, config):
+        self.url = config['KEYWORDS_API']
+        self.batch = config['KEYWORDS_BATCH']
+        self.timeout = config['KEYWORDS_TIMEOUT']
+        self.bucket = TokenBucket(config['KEYWORDS_RATE'])
+        self.cache = KeywordCache(config['KEYWORDS_CACHE_DB'], config['KEYWORDS_CACHE_SIZE'])
+
+    def blurb(self, fact):
+        return '"' + (fact.get('pre') or '') + ' ' + (fact.get('fact') or '') + ' ' + (fact.get('post') or '') + '"'
+
+    def _lookup(self, blurbs):
+        self.bucket.take()
+        if len(blurbs) == 1 and self.batch == 1:
+            return [requests.get(self.url, params={'blurb': blurbs[0]}, timeout=self.timeout).json()]
+        return requests.post(self.url, data=json.dumps({"blurbs": blurbs}), headers={'Content-Type': 'application/json'}, timeout=self.timeout).json()
+
+    def enrich(self, facts):
+        # set the keywords of each fact, looking up each distinct blurb that is not cached just once
+        keys = {}
+        for fact in facts:
+            b = self.blurb(fact)
+            keys.setdefault(hashlib.sha1(b.encode('utf-8')).hexdigest(), b)
+        found = self.cache.get(keys.keys())
+        todo = [key for key in keys if key not in found]
+        for i in range(0, len(todo), self.batch):
+            chunk = todo[i:i+self.batch]
+            looked = dict(zip(chunk, self._lookup([keys[key] for key in chunk])))
+            self.cache.put(looked)
+            found.update(looked)
+        for fact in facts:
+            fact['keywords'] = found.get(hashlib.sha1(self.blurb(fact).encode('utf-8')).hexdigest(), [])
+        return facts
+
+
+def stub(port=5112):
+    import BaseHTTPServer, urlparse
+    def keywords(blurb):
+        return [w.strip('".,;()') for w in blurb.split() if len(w.strip('".,;()')) > 3]
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def _send(self, res):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(res))
+        def do_GET(self):
+            self._send(keywords(urlparse.parse_qs(urlparse.urlparse(self.path).query).get('blurb',[''])[0]))
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.getheader('content-length'))))
+            self._send([keywords(b) for b in body['blurbs']])
+    BaseHTTPServer.HTTPServer(('127.0.0.1', port), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    stub()
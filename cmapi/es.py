@@ -0,0 +1,113 @@
+
+'''
+The client for all traffic to elasticsearch
+Each worker process keeps one requests Session, so connections to ES_HOST are pooled and kept alive rather than
+opened anew for every call. Every call has a timeout, and calls that fail to connect, time out, or get a 502,
+503 or 504 back are retried with exponential backoff.
+The settings are taken from cmapi.settings, and create_app calls configure so that app.cfg overrides apply.
+
+bootstrap makes the facts index and puts its mapping if the index is not there yet. With ES_BOOTSTRAP = 'once'
+create_app runs it through bootstrap_once, so that only the first process to start on the box makes the calls,
+and the rest just see the mark file it leaves - the mark is only left once ES has taken both calls, so a
+failed bootstrap is tried again by the next process to start. With 'cli' the app does nothing, and it is run with
+python -m cmapi.es bootstrap
+as part of deploying. 'worker' is the old way, every worker process checking the index as it starts.
+'''
+
+import os, time, json, fcntl, hashlib
+from cmapi import settings
+
+CONFIG = {
+    "ES_POOL_SIZE": settings.ES_POOL_SIZE,
+    "ES_TIMEOUT": settings.ES_TIMEOUT,
+    "ES_RETRIES": settings.ES_RETRIES,
+    "ES_BACKOFF": settings.ES_BACKOFF
+}
+
+_session = None
+_pid = None
+
+def configure(config):
+    global _session
+    for k in CONFIG.keys():
+        CONFIG[k] = config.get(k, CONFIG[k])
+    _session = None
+
+def session():
+    # a session is not shared across a fork, so a worker that finds one made by another process makes its own
+    # requests is only imported by the processes that call ES, not by every one that imports the app
+    global _session, _pid
+    if _session is None or _pid != os.getpid():
+        import requests
+        from requests.adapters import HTTPAdapter
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=CONFIG['ES_POOL_SIZE'])
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        _pid = os.getpid()
+    return _session
+
+def request(method, url, **kwargs):
+    import requests
+    kwargs['timeout'] = kwargs.get('timeout', CONFIG['ES_TIMEOUT'])
+    attempt = 0
+    while True:
+        try:
+            r = session().request(method, url, **kwargs)
+            if r.status_code not in [502,503,504] or attempt >= CONFIG['ES_RETRIES']:
+                return r
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt >= CONFIG['ES_RETRIES']:
+                raise
+        time.sleep(CONFIG['ES_BACKOFF'] * 2 ** attempt)
+        attempt += 1
+
+def head(url, **kwargs):
+    return request('HEAD', url, **kwargs)
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
+
+
+def bootstrap(config):
+    # make the facts index with its mapping, if it is not there
+    # raises if ES refuses either call, so that no mark is left and it is tried again
+    if head(config['FACT_API']).status_code == 200:
+        return 'exists'
+    for call in [lambda: post(config['FACT_API']), lambda: put(config['MAPPING_URL'], data=json.dumps(config['MAPPING']))]:
+        r = call()
+        if r.status_code >= 300:
+            raise Exception('Could not make the facts index, ES answered ' + str(r.status_code) + ' to ' + r.request.method + ' ' + r.url + ': ' + r.text)
+    return 'created'
+
+def bootstrap_once(config):
+    # bootstrap, unless a process has already done so for this index and mapping - the mark file is named by a
+    # hash of them, so a new mapping is put once too
+    key = hashlib.sha1(config['FACT_API'] + json.dumps(config['MAPPING'], sort_keys=True)).hexdigest()
+    mark = os.path.join(config['ES_BOOTSTRAP_DIR'], 'es-' + key)
+    if os.path.exists(mark): return 'done'
+    if not os.path.exists(config['ES_BOOTSTRAP_DIR']): os.makedirs(config['ES_BOOTSTRAP_DIR'])
+    with open(mark + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(mark): return 'done'
+        res = bootstrap(config)
+        open(mark, 'w').close()
+    return res
+
+
+if __name__ == "__main__":
+    import sys
+    from cmapi.app import app
+    if len(sys.argv) > 1 and sys.argv[1] == 'bootstrap':
+        print bootstrap(app.config)
+    else:
+        print 'usage: python -m cmapi.es bootstrap'
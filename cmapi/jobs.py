@@ -0,0 +1,159 @@
+
+'''
+A local job queue for processor runs
+Jobs are kept in a SQLite database so that queued work survives a restart of the app or the workers.
+The web app only submits jobs and reads back their status - see the async param on the processor routes.
+A separate bounded pool of worker processes claims queued jobs and runs the processors. Start it with
+python -m cmapi.jobs (see deploy/cmapi.conf) - the number of workers is set by JOBS_WORKERS.
+Any job found running when the pool starts was interrupted by a restart, so it is queued again.
+The pool is watched, and a worker that dies (e.g. killed for using too much memory) is replaced, with the job it
+had claimed queued again - unless that job has now killed JOBS_RETRIES workers, when it is failed instead.
+'''
+
+import os, sqlite3, json, uuid, time, multiprocessing
+from datetime import datetime
+from cmapi.admission import Busy
+from cmapi.translator import encode
+
+class JobQueue(object):
+    def __init__(self, path):
+        self.path = path
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, processor TEXT, params TEXT, status TEXT, result TEXT, created_date TEXT, updated_date TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+        # the pid of the worker running a job, and how many workers have died running it
+        for column in ['worker INTEGER', 'crashes INTEGER DEFAULT 0']:
+            try:
+                conn.execute('ALTER TABLE jobs ADD COLUMN ' + column)
+            except sqlite3.OperationalError:
+                pass
+        conn.close()
+
+    def _conn(self):
+        # autocommit, so that claim can take the write lock itself with BEGIN IMMEDIATE
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _now(self):
+        return datetime.now().strftime("%Y-%m-%d %H%M")
+
+    def submit(self, processor, params):
+        jid = uuid.uuid4().hex
+        conn = self._conn()
+        conn.execute('INSERT INTO jobs (id, processor, params, status, result, created_date, updated_date) VALUES (?,?,?,?,?,?,?)', (jid, processor, json.dumps(params), 'queued', None, self._now(), self._now()))
+        conn.close()
+        return jid
+
+    def get(self, jid):
+        conn = self._conn()
+        row = conn.execute('SELECT id, processor, params, status, result, created_date, updated_date FROM jobs WHERE id = ?', (jid,)).fetchone()
+        conn.close()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "processor": row[1],
+            "params": json.loads(row[2]),
+            "status": row[3],
+            "result": json.loads(row[4]) if row[4] is not None else None,
+            "created_date": row[5],
+            "updated_date": row[6]
+        }
+
+    def claim(self, worker=None):
+        # take the oldest queued job and mark it running under the pid of the worker, so no other worker can
+        # take it too
+        conn = self._conn()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY rowid LIMIT 1").fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = 'running', worker = ?, updated_date = ? WHERE id = ?", (worker, self._now(), row[0]))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return self.get(row[0]) if row is not None else None
+
+    def _set(self, jid, status, result):
+        conn = self._conn()
+        conn.execute('UPDATE jobs SET status = ?, result = ?, updated_date = ? WHERE id = ?', (status, json.dumps(result, default=encode), self._now(), jid))
+        conn.close()
+
+    def finish(self, jid, result):
+        self._set(jid, 'done', result)
+
+    def fail(self, jid, error):
+        self._set(jid, 'failed', {"errors": [error]})
+
+    def requeue(self, jid=None):
+        # queue a running job again, or all running jobs if no jid is given
+        conn = self._conn()
+        if jid is None:
+            conn.execute("UPDATE jobs SET status = 'queued', updated_date = ? WHERE status = 'running'", (self._now(),))
+        else:
+            conn.execute("UPDATE jobs SET status = 'queued', updated_date = ? WHERE id = ?", (self._now(), jid))
+        conn.close()
+
+    def died(self, worker, retries):
+        # queue the job a dead worker was running again, or fail it if it has killed retries workers
+        conn = self._conn()
+        rows = conn.execute("SELECT id, crashes FROM jobs WHERE status = 'running' AND worker = ?", (worker,)).fetchall()
+        conn.close()
+        for jid, crashes in rows:
+            crashes = (crashes or 0) + 1
+            conn = self._conn()
+            conn.execute('UPDATE jobs SET crashes = ? WHERE id = ?', (crashes, jid))
+            conn.close()
+            if crashes >= retries:
+                self.fail(jid, 'The worker running this job died ' + str(crashes) + ' times.')
+            else:
+                self.requeue(jid)
+        return [r[0] for r in rows]
+
+
+def work(path, poll=1):
+    # the loop run by each worker process of the pool
+    from cmapi.app import app
+    from cmapi import registry
+    q = JobQueue(path)
+    while True:
+        job = q.claim(os.getpid())
+        if job is None:
+            time.sleep(poll)
+            continue
+        try:
+            with app.app_context():
+                q.finish(job['id'], registry.get(job['processor'])().run(**job['params']))
+        except Busy, e:
+            # the processor is at its limit, so the job goes back in the queue for later
+            q.requeue(job['id'])
+            time.sleep(e.retry)
+        except Exception, e:
+            q.fail(job['id'], str(e))
+
+
+def _start(path):
+    p = multiprocessing.Process(target=work, args=(path,))
+    p.start()
+    return p
+
+def serve(path, workers, retries=3, poll=1):
+    # start the pool, and replace any worker that dies
+    q = JobQueue(path)
+    q.requeue()
+    pool = [_start(path) for i in range(workers)]
+    while True:
+        for i, p in enumerate(pool):
+            if not p.is_alive():
+                p.join()
+                jids = q.died(p.pid, retries)
+                print 'worker ' + str(p.pid) + ' died with exit code ' + str(p.exitcode) + ' running ' + (', '.join(jids) if len(jids) > 0 else 'no job') + ', starting another'
+                pool[i] = _start(path)
+        time.sleep(poll)
+
+
+if __name__ == "__main__":
+    from cmapi.app import app
+    serve(app.config['JOBS_DB'], app.config['JOBS_WORKERS'], app.config['JOBS_RETRIES'])
@@ -0,0 +1,79 @@
+
+'''
+Histograms of where the time of each processor run goes
+Processor.run times its stages - the wait for an admission slot, before, the command itself (wall and CPU
+time), after, translating the results files - and counts the facts found and the bytes of the files written.
+Each run is added to histograms per processor, kept in the SQLite db at METRICS_DB so that the counts of every
+gunicorn and job worker process add up together, and /metrics serves them in the Prometheus text format.
+The time each worker process takes to start the app is recorded too, under the name app.
+'''
+
+import sqlite3
+
+SECONDS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+FACTS = [0, 1, 10, 100, 1000, 10000, 100000, 1000000]
+BYTES = [1000, 10000, 100000, 1000000, 10000000, 100000000, 1000000000]
+
+# the timings of a run that are recorded, with the name, help and buckets of the histogram of each
+HISTOGRAMS = {
+    'queue': ('cmapi_processor_queue_seconds', 'Time waiting for an admission slot.', SECONDS),
+    'before': ('cmapi_processor_before_seconds', 'Time in before.', SECONDS),
+    'execute': ('cmapi_processor_execute_seconds', 'Wall time of the command.', SECONDS),
+    'cpu': ('cmapi_processor_cpu_seconds', 'CPU time of the command, user and system.', SECONDS),
+    'after': ('cmapi_processor_after_seconds', 'Time in after, including translating results.', SECONDS),
+    'translate': ('cmapi_processor_translate_seconds', 'Time reading and translating results files.', SECONDS),
+    'total': ('cmapi_processor_seconds', 'Time of the whole run.', SECONDS),
+    'facts': ('cmapi_processor_facts', 'Facts found by a run.', FACTS),
+    'bytes': ('cmapi_processor_bytes', 'Bytes of the files written by a run.', BYTES),
+    'start': ('cmapi_start_seconds', 'Time from a worker process importing the app to the app being ready, recorded under processor app.', SECONDS)
+}
+
+class Metrics(object):
+    def __init__(self, path):
+        self.path = path
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS buckets (metric TEXT, processor TEXT, le REAL, count INTEGER, PRIMARY KEY (metric, processor, le))')
+        conn.execute('CREATE TABLE IF NOT EXISTS sums (metric TEXT, processor TEXT, count INTEGER, sum REAL, PRIMARY KEY (metric, processor))')
+        conn.close()
+
+    def _conn(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def record(self, processor, timings):
+        # add the timings of one run to the histograms of its processor, in one transaction
+        conn = self._conn()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for metric, value in timings.items():
+                if metric not in HISTOGRAMS or value is None: continue
+                for le in HISTOGRAMS[metric][2] + [float('inf')]:
+                    if value <= le:
+                        conn.execute('INSERT OR IGNORE INTO buckets VALUES (?,?,?,0)', (metric, processor, le))
+                        conn.execute('UPDATE buckets SET count = count + 1 WHERE metric = ? AND processor = ? AND le = ?', (metric, processor, le))
+                conn.execute('INSERT OR IGNORE INTO sums VALUES (?,?,0,0)', (metric, processor))
+                conn.execute('UPDATE sums SET count = count + 1, sum = sum + ? WHERE metric = ? AND processor = ?', (value, metric, processor))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def render(self):
+        # the histograms in the Prometheus text format - buckets no run has reached yet are given as 0
+        conn = self._conn()
+        counts = {(m, p, le): c for m, p, le, c in conn.execute('SELECT metric, processor, le, count FROM buckets')}
+        sums = {(m, p): (c, s) for m, p, c, s in conn.execute('SELECT metric, processor, count, sum FROM sums')}
+        conn.close()
+        lines = []
+        for metric in sorted(HISTOGRAMS.keys()):
+            name, help, buckets = HISTOGRAMS[metric]
+            lines.append('# HELP ' + name + ' ' + help)
+            lines.append('# TYPE ' + name + ' histogram')
+            for processor in sorted(set(p for m, p in sums.keys() if m == metric)):
+                label = 'processor="' + processor + '"'
+                for le in buckets + [float('inf')]:
+                    lines.append(name + '_bucket{' + label + ',le="' + ('+Inf' if le == float('inf') else repr(le)) + '"} ' + str(counts.get((metric, processor, le), 0)))
+                lines.append(name + '_sum{' + label + '} ' + repr(sums[(metric, processor)][1]))
+                lines.append(name + '_count{' + label + '} ' + str(sums[(metric, processor)][0]))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,104 @@
+
+'''
+Runs the processors for one article as a single pipeline
+fetch (quickscrape, or a direct retrieve of the url if quickscrape gets no fulltext) -> norma -> the ami2 extractors
+The stages form a dependency graph, and every stage whose dependencies are complete is started straight away
+in its own thread, so the ami2 extractors all run at the same time once scholarly.html exists.
+A stage is skipped if its outputs are already in the storage directory of the cid, unless force is set.
+If a stage fails to produce its outputs, the stages that depend on it are not run.
+'''
+
+import os, uuid, threading, Queue
+from cmapi import processors, storage
+
+# outputs are paths relative to the storage dir of the cid - for fetch any one of them will do
+STAGES = {
+    'fetch': {
+        'after': [],
+        'outputs': ['fulltext.xml','fulltext.html','fulltext.pdf'],
+        'any': True
+    },
+    'norma': {
+        'processor': processors.Norma,
+        'after': ['fetch'],
+        'outputs': ['scholarly.html']
+    },
+    'amispecies': {
+        'processor': processors.Amispecies,
+        'after': ['norma'],
+        'outputs': ['results/species/' + tp + '/results.xml' for tp in ['binomial','genus','genussp']]
+    },
+    'amiregex': {
+        'processor': processors.Amiregex,
+        'after': ['norma'],
+        'outputs': ['results/regex/concatenated/results.xml']
+    },
+    'amiidentifier': {
+        'processor': processors.Amiidentifier,
+        'after': ['norma'],
+        'outputs': ['results/identifier/results.xml']
+    }
+}
+
+class Pipeline(object):
+    def __init__(self, app, cid=None, url=None, force=False, stages=None):
+        self.app = app
+        self.cid = cid if cid is not None else uuid.uuid4().hex
+        self.url = url
+        self.force = force
+        self.stages = {k: STAGES[k] for k in (stages if stages is not None else STAGES.keys())}
+        self.output = {"cid": self.cid, "stages": {}}
+
+    def _exists(self, name):
+        dr = storage.store(self.app.config).dir(self.cid)
+        found = [os.path.exists(os.path.join(dr, o)) for o in self.stages[name]['outputs']]
+        return any(found) if self.stages[name].get('any',False) else all(found)
+
+    def _fetch(self):
+        if self.url is None:
+            return {"errors": ["No url to fetch from, and no fulltext on disk for this cid."]}
+        res = processors.Quickscrape().run(url=self.url, cid=self.cid)
+        if not self._exists('fetch'):
+            res = processors.Retrieve().run(url=self.url, cid=self.cid)
+        return res
+
+    def _stage(self, name, done):
+        with self.app.app_context():
+            try:
+                if name == 'fetch':
+                    res = self._fetch()
+                else:
+                    # a stage only runs when its outputs are missing or force is set, so the files have to be
+                    # written again - a cached response would not do that
+                    res = self.stages[name]['processor']().run(cid=self.cid, cache=False)
+            except Exception, e:
+                res = {"errors": [str(e)]}
+        done.put((name, res))
+
+    def run(self):
+        done = Queue.Queue()
+        waiting = set(self.stages.keys())
+        complete = set()
+        running = 0
+        while len(waiting) > 0 or running > 0:
+            for name in list(waiting):
+                deps = [d for d in self.stages[name]['after'] if d in self.stages]
+                if any(d in waiting or self.output['stages'].get(d,{}).get('status') == 'running' for d in deps):
+                    continue
+                waiting.discard(name)
+                if any(d not in complete for d in deps):
+                    self.output['stages'][name] = {"status": "blocked", "after": deps}
+                elif not self.force and self._exists(name):
+                    self.output['stages'][name] = {"status": "skipped"}
+                    complete.add(name)
+                else:
+                    self.output['stages'][name] = {"status": "running"}
+                    threading.Thread(target=self._stage, args=(name, done)).start()
+                    running += 1
+            if running > 0:
+                name, res = done.get()
+                running -= 1
+                res['status'] = 'complete' if self._exists(name) else 'failed'
+                if res['status'] == 'complete': complete.add(name)
+                self.output['stages'][name] = res
+        return self.output
@@ -16,25 +16,66 @@ It can also be programmed using the available overwriteable methods to store the
 Make sure to use class names that start with one upper case letter and the rest lower case.
 '''
 
-import uuid, subprocess, os, shutil, json, requests, time
+import uuid, subprocess, os, shutil, time, threading, Queue, urlparse, resource
 from flask import current_app
-from cmapi.translator import Translator as translator
+from cmapi.translator import Translator as translator, Facts
+from cmapi.aggregate import aggregate
+from cmapi.cache import ResultCache
+from cmapi.admission import Slot, Busy
+from cmapi.spawn import spawn
+from cmapi.metrics import Metrics
+from cmapi.registry import register
+from cmapi.regexes import dictionaries
+from cmapi import storage
+
+def ready(path):
+    return os.path.exists(path) and os.path.getsize(path) > 0
+
+def wait(path, deadline):
+    # poll for the file with a growing interval until it is ready or the deadline passes
+    delay = current_app.config['READY_POLL']
+    while not ready(path) and time.time() + delay <= deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, current_app.config['READY_POLL_MAX'])
+    return ready(path)
+
+def illegal(value):
+    # whether an argument, or any item of a list of them, has a character that is not allowed in commands
+    if isinstance(value,list): return any(illegal(v) for v in value)
+    return isinstance(value,basestring) and ';' in value
+
+# the usage instructions given by every processor
+USAGE = [
+    "Called with no arguments, this route returns the usage instructions of the underlying codebase.",
+    "Arguments can be passed as GET URL parameters, or as a JSON object via POST.",
+    "Single-letter short versions or full-named versions of arguments can be used.",
+    "If single-letter arguments lack a preceding -, it will be automatically added. For full-named arguments, preceding -- will be added if not supplied.",
+    "Do not provide any output parameters - these are controlled by the API server.",
+    "Similarly any paramaters telling the software where to find any local files it should expect will be handled by the API server.",
+    "Output files will be saved to a folder and a URL will be provided for access to them.",
+    "Any direct output from the executed command will be returned in the response object, which is always a successful return of JSON content.",
+    "If a Catalogue ID (a cid) is available for a work being processed, it can be passed as the cid or --cid parameter. It will then be used to identify catalogue records and storage directories where necessary, so input parameters can be skipped.",
+    "Results of processing a cid are cached until its input files change. Pass cache=false to run the processor again anyway.",
+    "Quickscrape can scrape several urls at once, given as a list, or a comma-separated string, in the urls parameter. Each url is given a new cid of its own, so a cid passed along with urls is ignored.",
+    "Several works can be processed at once by passing a list of cids, or a comma-separated string of them, as the cids parameter. Processors that support it will process them in batches in a single command, and report the results for each cid.",
+    "Facts can be returned as columns, one list per field, with format=columnar, or as newline delimited JSON with format=ndjson - the first line is the rest of the response and each following line is one fact.",
+    "Amiregex runs all the regex dictionaries listed at /amiregex/meta at once, unless given the name of one, or a comma-separated list of several, as r.regex.",
+    "Pass timings=true to get the time taken by each stage of the run, and the facts and bytes it produced, in a timings block."
+]
 
 class Processor(object):
+    # set on processors whose command accepts several -q dirs, so that batches of cids run in one command
+    batchable = False
+    # the files in the storage dir of a cid that the command reads - results of processors that have some are cached
+    inputs = []
+    # the group in ADMISSION_LIMITS that caps how many runs of this processor's command can happen at once
+    admission = None
+    # whether meta is always the same, so that it can be worked out once and kept
+    static_meta = True
+
     def __init__(self):
-        self.output = {
-            "usage": [
-                "Called with no arguments, this route returns the usage instructions of the underlying codebase.",
-                "Arguments can be passed as GET URL parameters, or as a JSON object via POST.",
-                "Single-letter short versions or full-named versions of arguments can be used.",
-                "If single-letter arguments lack a preceding -, it will be automatically added. For full-named arguments, preceding -- will be added if not supplied.",
-                "Do not provide any output parameters - these are controlled by the API server.",
-                "Similarly any paramaters telling the software where to find any local files it should expect will be handled by the API server.",
-                "Output files will be saved to a folder and a URL will be provided for access to them.",
-                "Any direct output from the executed command will be returned in the response object, which is always a successful return of JSON content.",
-                "If a Catalogue ID (a cid) is available for a work being processed, it can be passed as the cid or --cid parameter. It will then be used to identify catalogue records and storage directories where necessary, so input parameters can be skipped."
-            ]
-        }
+        self.timings = {}
+        self.output = {"usage": USAGE}
     
     def _cmd(self, **kwargs):
         self.output['command'] = []
@@ -54,47 +95,213 @@ class Processor(object):
     def meta(self):
         return {} # a method to return any metadata that may be needed by UI to build user options
         
-    def run(self, before=True,after=True,store=True,save=True,**kwargs):
+    def _cdirs(self, cid):
+        # the storage dirs to pass to -q - a batch run has a list of cids, so gets several
+        return [self.store.dir(c) for c in (cid if isinstance(cid,list) else [cid])]
+
+    @property
+    def store(self):
+        return storage.store(current_app.config)
+
+    def _cids(self):
+        cid = self.output.get('cid',[])
+        return cid if isinstance(cid,list) else [cid]
+
+    def _facts(self, processor, paths):
+        # translate the results files found at paths under each cid dir of the run into facts
+        # a batch run reports the facts of each of its cids separately, under results
+        # files that cannot be read by the time the run deadline passes are reported under failures
+        # duplicate facts of a cid are collapsed into one with a count, if AGGREGATE_FACTS is set
+        facts = {}
+        deadline = time.time() + current_app.config['READY_TIMEOUT']
+        for cid in self._cids():
+            facts[cid] = Facts()
+            for path in paths:
+                results_file = self.store.dir(cid) + path
+                translating = time.time()
+                found, error = self._translate(processor, results_file, deadline)
+                self.timings['translate'] = self.timings.get('translate',0) + time.time() - translating
+                if found is not None:
+                    facts[cid].extend(found)
+                    self._wrote(os.path.getsize(results_file))
+                if error is not None:
+                    self.output['failures'] = self.output.get('failures',[]) + [{"cid": cid, "file": results_file, "error": error}]
+            if current_app.config['AGGREGATE_FACTS']:
+                facts[cid] = aggregate(facts[cid])
+        if isinstance(self.output.get('cid',None),list):
+            self.output['results'] = {cid: {"facts": facts[cid], "factcount": len(facts[cid])} for cid in facts}
+            self.output['factcount'] = sum([len(facts[cid]) for cid in facts])
+        else:
+            self.output['facts'] = facts.get(self.output.get('cid',None),[])
+            self.output['factcount'] = len(self.output['facts'])
+
+    def _translate(self, processor, results_file, deadline):
+        # the command has finished by now so the file should be there, but it is polled for with a growing
+        # interval until the deadline in case it is still being written - returns the facts and any error
+        delay = current_app.config['READY_POLL']
+        while True:
+            if ready(results_file):
+                try:
+                    return translator(processor=processor).facts(results_file), None
+                except Exception, e:
+                    error = 'Could not read results file: ' + str(e)
+            else:
+                error = 'Results file was not written.'
+            if time.time() + delay > deadline:
+                return None, error
+            time.sleep(delay)
+            delay = min(delay * 2, current_app.config['READY_POLL_MAX'])
+
+    def batch(self, cids, **kwargs):
+        # processors that can take several -q dirs at once run a chunk of BATCH_SIZE cids in each command
+        # the others are run once per cid
+        if not isinstance(cids,list): cids = [c for c in cids.split(',') if len(c) > 0]
+        size = current_app.config['BATCH_SIZE'] if self.batchable else 1
+        output = {"cids": cids, "batches": [], "results": {}, "factcount": 0}
+        for i in range(0, len(cids), size):
+            chunk = cids[i:i+size]
+            res = self.__class__().run(cid=chunk if self.batchable else chunk[0], **kwargs)
+            if 'results' in res:
+                output['results'].update(res.pop('results'))
+            else:
+                output['results'][chunk[0]] = {k: res.pop(k) for k in ['facts','factcount'] if k in res}
+            output['batches'].append(res)
+        output['factcount'] = sum([r.get('factcount',0) for r in output['results'].values()])
+        return output
+
+    def _execute(self):
+        # run the command, putting what it printed into output and errors, and return its exit code
+        # the command goes to the engine of long-lived workers if there is one, see cmapi/engine.py
+        # either way it is held to the timeout set for this processor in PROCESS_LIMITS, which is per cid, so
+        # a batch gets that many times the timeout and CPU time of a single paper
+        name = self.__class__.__name__.lower()
+        limits = dict(current_app.config['PROCESS_LIMITS'].get(name, current_app.config['PROCESS_LIMITS']['default']))
+        n = max(1, len(self._cids()))
+        for k in ['timeout','cpu']:
+            if limits.get(k,None) is not None: limits[k] = limits[k] * n
+        if current_app.config.get('ENGINE',False):
+            from cmapi import engine
+            res = engine.execute(current_app.config['ENGINE_SOCKET'], self.output['command'], limits.get('timeout',None), current_app.config['OUTPUT_TAIL'])
+            if res is not None:
+                self.output['output'], self.output['errors'] = res['output'], res['errors']
+                if res.get('timedout',False):
+                    self.output['failures'] = self.output.get('failures',[]) + [{"error": "Command was stopped after running for " + str(limits['timeout']) + " seconds."}]
+                return res['code']
+        # otherwise it is run here within the rest of its limits, and for a single cid the full output is
+        # logged to the logs dir in its storage dir, with only the tail returned
+        cid = self.output.get('cid',None)
+        logdir = self.store.path(cid, 'logs') if isinstance(cid,basestring) and os.path.isdir(self.store.dir(cid)) else None
+        code, self.output['output'], self.output['errors'], timedout = spawn(
+            self.output['command'],
+            timeout=limits.get('timeout',None),
+            cpu=limits.get('cpu',None),
+            memory=limits.get('memory',None),
+            tail=current_app.config['OUTPUT_TAIL'],
+            logdir=logdir,
+            name=name
+        )
+        if logdir is not None:
+            self.output['logs'] = [self.store.url(cid, 'logs/' + name + '.' + s + '.log') for s in ['stdout','stderr']]
+        if timedout:
+            self.output['failures'] = self.output.get('failures',[]) + [{"error": "Command was stopped after running for " + str(limits['timeout']) + " seconds."}]
+        return code
+
+    def _cache(self):
+        # results are only cached for processors that read their input files from the storage dir of a cid
+        if not current_app.config.get('CACHE',False) or len(self.inputs) == 0 or 'cid' not in self.output:
+            return None
+        return ResultCache(current_app.config['CACHE_DB'], current_app.config['CACHE_MAX_SIZE'], current_app.config['CACHE_MAX_AGE'])
+
+    def _wrote(self, size):
+        # count bytes of files written by the run, for the bytes metric
+        self.timings['bytes'] = self.timings.get('bytes',0) + size
+
+    def _timings(self, requested):
+        # record the timings of the run in the metrics, and put them in the output if they were asked for
+        # the work is done by now, so a metrics db that cannot be written to must not fail the run
+        if current_app.config.get('METRICS',False):
+            try:
+                Metrics(current_app.config['METRICS_DB']).record(self.__class__.__name__.lower(), self.timings)
+            except Exception, e:
+                print 'could not record the timings of the run: ' + str(e)
+        if str(requested).lower() in ['true','1','yes']:
+            self.output['timings'] = self.timings
+
+    def run(self, before=True,after=True,store=True,save=True,cache=True,timings=False,**kwargs):
         # check for dodgy characters in the kwargs
         if 'callback' in kwargs: del kwargs['callback']
         if '_' in kwargs: del kwargs['_']
         for k in kwargs.keys():
-            if ';' in k or ';' in kwargs[k]:
+            if ';' in k or illegal(kwargs[k]):
                 self.output['errors'] = ['Sorry, illegal character found in args.']
                 return self.output
+        if 'cids' in kwargs:
+            return self.batch(kwargs.pop('cids'), before=before, after=after, store=store, save=save, cache=cache, timings=timings, **kwargs)
+        start = time.time()
         if before: self.before(**kwargs)
+        self.timings['before'] = time.time() - start
         self._cmd(**kwargs)
+        rc = self._cache() if str(cache).lower() not in ['false','0','no'] else None
+        key = rc.key(self.__class__.__name__, self.output['command'], self._cdirs(self.output['cid']), self.inputs) if rc is not None else None
+        if key is not None:
+            hit = rc.get(key)
+            if hit is not None:
+                hit['cached'] = True
+                return hit
         try:
-            p = subprocess.Popen(self.output['command'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            self.output['output'], self.output['errors'] = p.communicate()
+            queued = time.time()
+            with Slot(self.admission, current_app.config):
+                self.timings['queue'] = time.time() - queued
+                # the CPU time of the command is that used by children of this process while it ran, which is
+                # exact in a sync worker but may take in other commands run at the same time in a threaded one
+                usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+                executed = time.time()
+                code = self._execute()
+                self.timings['execute'] = time.time() - executed
+                done = resource.getrusage(resource.RUSAGE_CHILDREN)
+                self.timings['cpu'] = (done.ru_utime - usage.ru_utime) + (done.ru_stime - usage.ru_stime)
+        except Busy:
+            raise
         except Exception, e:
             self.output['output'] = {}
             self.output['errors'] = [str(e)]
+            key = None
+        afterwards = time.time()
         if after: self.after(**kwargs)
+        self.timings['after'] = time.time() - afterwards
         if not isinstance(self.output['errors'],dict) and not isinstance(self.output['errors'],list):
             self.output['errors'] = [i for i in self.output['errors'].split('\n') if len(i) > 0]
         if not isinstance(self.output['output'],dict) and not isinstance(self.output['output'],list) and '\n' in self.output['output']:
             self.output['output'] = [i for i in self.output['output'].split('\n') if len(i) > 0]
+        if key is not None and code == 0 and 'failures' not in self.output: rc.put(key, self.output)
+        if 'factcount' in self.output: self.timings['facts'] = self.output['factcount']
+        self.timings['total'] = time.time() - start
+        self._timings(timings)
         return self.output
 
     
 
         
+@register
 class Quickscrape(Processor):
+    admission = 'quickscrape'
+
     def _cmd(self, **kwargs):
+        # each run writes to its own tmp dir, so that runs on the same url cannot collide
+        self.tmpdir = current_app.config['QS_TMP_DIR'] + uuid.uuid4().hex + '/'
         self.output['command'] = ['quickscrape']
         if len(kwargs) > 0:
             for key in kwargs.keys():
                 k = key
                 if not key.startswith('-'): k = '-' + k
                 if len(key) > 2: k = '-' + k
-                if k not in ['-d','--scraperdir','-o','--output','-f','--outformat']:
+                if k not in ['-d','--scraperdir','-o','--output','-f','--outformat','--cid']:
                     self.output['command'].append(k)
                     self.output['command'].append(kwargs[key])
             self.output['command'].append('--scraperdir')
             self.output['command'].append(current_app.config['QS_JS_DIR'])
             self.output['command'].append('--output')
-            self.output['command'].append(current_app.config['QS_TMP_DIR'])
+            self.output['command'].append(self.tmpdir)
             self.output['command'].append('--outformat')
             self.output['command'].append('bibjson')
         else:
@@ -106,26 +313,69 @@ class Quickscrape(Processor):
         if turl is not None:
             slug = turl.replace('://','_').replace('/','_').replace(':','')
             self.output['cid'] = kwargs.get('cid',uuid.uuid4().hex)
-            self.output['store'] = 'http://store.cottagelabs.com/' + self.output['cid']
+            self.output['store'] = self.store.url(self.output['cid'])
             self.output['files'] = []
-            tmpdir = current_app.config['QS_TMP_DIR'] + slug
-            outdir = current_app.config['STORAGE_DIR'] + self.output['cid']
-            if not os.path.exists(outdir):
-                os.makedirs(outdir)
-            for fl in os.listdir(tmpdir):
-                shutil.copy(os.path.join(tmpdir, fl), outdir)
-                self.output['files'].append(self.output['store'] + '/' + fl)
-                '''if fl == 'bib.json':
+            tmpdir = self.tmpdir + slug
+            if not os.path.exists(tmpdir):
+                self.output['failures'] = self.output.get('failures',[]) + [{"url": turl, "error": "Nothing was scraped from the url."}]
+            else:
+                for fl in os.listdir(tmpdir):
+                    self._wrote(self.store.add(self.output['cid'], os.path.join(tmpdir, fl), fl)['size'])
+                    self.output['files'].append(self.store.url(self.output['cid'], fl))
+                    '''if fl == 'bib.json':
+                        try:
+                            self.output['bibjson'] = json.load(open(tmpdir + '/' + fl))
+                        except:
+                            pass'''
+        if hasattr(self, 'tmpdir') and os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def run(self, **kwargs):
+        if 'urls' in kwargs:
+            return self.fanout(kwargs.pop('urls'), **kwargs)
+        return super(Quickscrape, self).run(**kwargs)
+
+    def fanout(self, urls, **kwargs):
+        # scrape each of a list of urls in its own run, QS_CONCURRENCY at a time, starting runs on the same
+        # domain no closer together than QS_DOMAIN_INTERVAL seconds - each url gets its own cid, so any cid or
+        # url given along with the urls is dropped
+        if not isinstance(urls,list): urls = [u for u in urls.split(',') if len(u) > 0]
+        for k in ['cid','--cid','url','--url']: kwargs.pop(k, None)
+        app = current_app._get_current_object()
+        todo = Queue.Queue()
+        for u in urls: todo.put(u)
+        results = {}
+        lock = threading.Lock()
+        starts = {}
+        def scrape():
+            while True:
+                try:
+                    u = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                domain = urlparse.urlparse(u).netloc
+                with lock:
+                    start = max(time.time(), starts.get(domain,0))
+                    starts[domain] = start + app.config['QS_DOMAIN_INTERVAL']
+                time.sleep(max(0, start - time.time()))
+                with app.app_context():
                     try:
-                        self.output['bibjson'] = json.load(open(tmpdir + '/' + fl))
-                    except:
-                        pass'''
-            shutil.rmtree(tmpdir)
+                        res = Quickscrape().run(url=u, cid=uuid.uuid4().hex, **kwargs)
+                        results[u] = {"cid": res.get('cid',None), "files": res.get('files',[]), "errors": res.get('errors',[]) + res.get('failures',[])}
+                    except Exception, e:
+                        results[u] = {"cid": None, "files": [], "errors": [str(e)]}
+        threads = [threading.Thread(target=scrape) for i in range(min(app.config['QS_CONCURRENCY'], len(urls)))]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        return {"urls": [dict(results[u], url=u) for u in urls]}
 
         
         
-
+@register
 class Norma(Processor):
+    admission = 'norma'
+    # not cached - what norma makes is scholarly.html, which a cached response would not bring back
+
     def _cmd(self, **kwargs):
         self.output['command'] = ['norma']
         if len(kwargs.keys()) > 0 and 'x' not in kwargs.keys() and '-x' not in kwargs.keys() and 'xsl' not in kwargs.keys() and '--xsl' not in kwargs.keys() and 'x' not in kwargs.keys():
@@ -140,7 +390,7 @@ class Norma(Processor):
             if k == '--cid':                            
                 self.output['cid'] = kwargs[key]
                 self.output['command'].append('-q')
-                self.output['command'].append(current_app.config['STORAGE_DIR'] + str(kwargs[key]))
+                self.output['command'] += self._cdirs(kwargs[key])
                 self.output['command'].append('--input')
                 self.output['command'].append('fulltext.xml')
                 self.output['command'].append('--output')
@@ -149,20 +399,27 @@ class Norma(Processor):
                 self.output['command'].append(k)
                 self.output['command'].append(kwargs[key])
 
+    def before(self, **kwargs):
+        # scholarly.html may be an alias of another html file, which norma must not write over
+        if kwargs.get('cid',False):
+            self.store.unshare(kwargs['cid'], 'scholarly.html')
+
     def after(self, **kwargs):
         if kwargs.get('cid',False):
-            self.output['store'] = 'http://store.cottagelabs.com/' + self.output['cid']
+            cid = self.output['cid']
+            self.output['store'] = self.store.url(cid)
             self.output['files'] = []
-            dr = current_app.config['STORAGE_DIR'] + self.output['cid']
-            listfiles = os.listdir(dr)
+            manifest = self.store.sync(cid)
+            listfiles = manifest.keys()
+            if 'scholarly.html' in manifest: self._wrote(manifest['scholarly.html']['size'])
             for fl in listfiles:
                 if 'scholarly.html' not in listfiles and fl.lower().endswith('.html'):
-                    shutil.copy(os.path.join(dr, fl), os.path.join(dr, 'scholarly.html'))
+                    self.store.alias(cid, fl, 'scholarly.html')
                     self.output['transposed'] = fl
-                    self.output['shtml'] = self.output['store'] + '/scholarly.html'
-                self.output['files'].append(self.output['store'] + '/' + fl)
+                    self.output['shtml'] = self.store.url(cid, 'scholarly.html')
+                self.output['files'].append(self.store.url(cid, fl))
             if 'scholarly.html' in listfiles:
-                self.output['shtml'] = self.output['store'] + '/scholarly.html'
+                self.output['shtml'] = self.store.url(cid, 'scholarly.html')
 
 '''how many -x are there? is there a list? - look in stylesheetbyname.xml
 /norma/src/main/resources ... /org/xmlcml/norma/pubstyle/stylesheetByName.xml
@@ -173,22 +430,29 @@ class Norma(Processor):
 </stylesheetList>'''
 
             
+@register
 class Amiregex(Processor):
+    # the regexes can be added to while the app is running
+    static_meta = False
+    admission = 'ami2'
+    batchable = True
+    inputs = ['scholarly.html']
+
     def meta(self):
-        # TODO: this should be set by app config...
-        r = {'regexes':[]}
-        try:
-            for fl in os.listdir(current_app.config['REGEXES_DIR']):
-                r['regexes'].append(fl.replace('.xml',''))
-        except:
-            pass
-        return r
+        return dictionaries(current_app.config).meta()
+
+    def _regexes(self, names=None, title='concatenated'):
+        # the combined regex file of the named dictionaries, see cmapi/regexes.py
+        fl = dictionaries(current_app.config).combined(names, title)
+        return fl if fl is not None else current_app.config['REGEXES_DIR'] + title + '.xml'
         
     def _cmd(self, **kwargs):
         self.output['command'] = ['/usr/bin/ami2-regex']
-        if 'r.r' not in kwargs.keys() and '-r.r' not in kwargs.keys() and '--r.regex' not in kwargs.keys():
+        self.unknown = []
+        # the regex can be given as r.r, -r.r, r.regex or --r.regex
+        if len(set(kwargs.keys()) & set(['r.r','-r.r','r.regex','--r.regex'])) == 0:
             self.output['command'].append('-r.r')
-            self.output['command'].append(current_app.config['REGEXES_DIR'] + 'concatenated.xml')
+            self.output['command'].append(self._regexes())
             self.output['regex'] = 'concatenated'
         for key in kwargs.keys():
             k = key
@@ -197,44 +461,48 @@ class Amiregex(Processor):
             if k == '--cid':
                 self.output['cid'] = kwargs[key]
                 self.output['command'].append('-q')
-                self.output['command'].append(current_app.config['STORAGE_DIR'] + str(kwargs[key]))
+                self.output['command'] += self._cdirs(kwargs[key])
                 self.output['command'].append('--input')
                 self.output['command'].append('scholarly.html')
                 #self.output['command'].append('--output')
                 #self.output['command'].append('results')
-            elif k in ['-r.r','--r.regex']:
+            elif k in ['-r.r','--r.r','--r.regex']:
                 self.output['command'].append('-r.r')
                 if kwargs[key].startswith('http'):
                     self.output['command'].append(kwargs[key])
                     self.output['regex'] = 'web'
                 else:
-                    self.output['command'].append(current_app.config['REGEXES_DIR'] + kwargs[key] + '.xml')
-                    self.output['regex'] = kwargs[key]
+                    # named dictionaries, even just one, go through the index, so that the file run - and so the
+                    # result cache key - changes when one of them does
+                    names = sorted(n for n in kwargs[key].split(',') if len(n) > 0)
+                    self.unknown = [n for n in names if n not in dictionaries(current_app.config).names()]
+                    self.output['regex'] = '_'.join(names)
+                    self.output['command'].append(self._regexes(names, self.output['regex']))
             else:
                 self.output['command'].append(k)
                 self.output['command'].append(kwargs[key])
             
             
+    def _execute(self):
+        if len(self.unknown) > 0:
+            self.output['output'] = ''
+            self.output['errors'] = 'No regex dictionary called ' + ', '.join(self.unknown) + ' - see /amiregex/meta for the ones there are.'
+            return 1
+        return Processor._execute(self)
+
     def after(self, **kwargs):
-        self.output['facts'] = []
-        if 'cid' in self.output:
-            results_file = current_app.config['STORAGE_DIR'] + self.output['cid'] + '/results/regex/' + self.output['regex'] + '/results.xml'
-            #ns = etree.FunctionNamespace("http://www.xml-cml.org/ami")
-            #ns.prefix = "zf"
-            counter = 0
-            success = False
-            while counter < 4 and not success:
-                try:
-                    t = translator(processor='amispecies')
-                    self.output['facts'] += t.translate(results_file)
-                    success = True
-                except:
-                    counter += 1
-                    time.sleep(10)
-        self.output['factcount'] = len(self.output['facts'])
+        if len(self.unknown) > 0: return
+        #ns = etree.FunctionNamespace("http://www.xml-cml.org/ami")
+        #ns.prefix = "zf"
+        self._facts('amispecies', ['/results/regex/' + self.output.get('regex','concatenated') + '/results.xml'])
 
         
+@register
 class Amispecies(Processor):
+    admission = 'ami2'
+    batchable = True
+    inputs = ['scholarly.html']
+
     def _cmd(self, **kwargs):
         self.output['command'] = ['/usr/bin/ami2-species']
         for key in kwargs.keys():
@@ -244,7 +512,7 @@ class Amispecies(Processor):
             if k == '--cid':
                 self.output['cid'] = kwargs[key]
                 self.output['command'].append('-q')
-                self.output['command'].append(current_app.config['STORAGE_DIR'] + str(kwargs[key]))
+                self.output['command'] += self._cdirs(kwargs[key])
                 self.output['command'].append('--input')
                 self.output['command'].append('scholarly.html')
                 self.output['command'].append('--sp.species')
@@ -260,24 +528,15 @@ class Amispecies(Processor):
                 self.output['command'].append(kwargs[key])
 
     def after(self, **kwargs):
-        self.output['facts'] = []
-        if 'cid' in self.output:
-            for tp in ['binomial','genus','genussp']:
-                results_file = current_app.config['STORAGE_DIR'] + self.output['cid'] + '/results/species/' + tp + '/results.xml'
-                counter = 0
-                success = False
-                while counter < 4 and not success:
-                    try:
-                        t = translator(processor='amispecies')
-                        self.output['facts'] += t.translate(results_file)
-                        success = True
-                    except:
-                        counter += 1
-                        time.sleep(10)
-        self.output['factcount'] = len(self.output['facts'])
+        self._facts('amispecies', ['/results/species/' + tp + '/results.xml' for tp in ['binomial','genus','genussp']])
 
 
+@register
 class Amiidentifier(Processor):
+    admission = 'ami2'
+    batchable = True
+    inputs = ['scholarly.html']
+
     def _cmd(self, **kwargs):
         self.output['command'] = ['/usr/bin/ami2-identifier']
         for key in kwargs.keys():
@@ -287,7 +546,7 @@ class Amiidentifier(Processor):
             if k == '--cid':
                 self.output['cid'] = kwargs[key]
                 self.output['command'].append('-q')
-                self.output['command'].append(current_app.config['STORAGE_DIR'] + str(kwargs[key]))
+                self.output['command'] += self._cdirs(kwargs[key])
                 self.output['command'].append('--input')
                 self.output['command'].append('scholarly.html')
                 self.output['command'].append('--context')
@@ -303,24 +562,12 @@ class Amiidentifier(Processor):
                 self.output['command'].append(kwargs[key])
  
     def after(self, **kwargs):
-        self.output['facts'] = []
-        if 'cid' in self.output:
-            results_file = current_app.config['STORAGE_DIR'] + self.output['cid'] + '/results/identifier/results.xml'
-            counter = 0
-            success = False
-            while counter < 4 and not success:
-                try:
-                    t = translator(processor='amiidentifier')
-                    self.output['facts'] += t.translate(results_file)
-                    success = True
-                except:
-                    counter += 1
-                    time.sleep(10)
-        self.output['factcount'] = len(self.output['facts'])
+        self._facts('amiidentifier', ['/results/identifier/results.xml'])
 
 
 
 '''        
+@register
 class Amiword(Processor):
     def _cmd(self, **kwargs):
         self.output['command'] = ['/usr/bin/ami2-word']
@@ -331,7 +578,7 @@ class Amiword(Processor):
             if k == '--cid':
                 self.output['cid'] = kwargs[key]
                 self.output['command'].append('-q')
-                self.output['command'].append(current_app.config['STORAGE_DIR'] + str(kwargs[key]))
+                self.output['command'] += self._cdirs(kwargs[key])
                 self.output['command'].append('--input')
                 self.output['command'].append('scholarly.html')
             else:
@@ -339,6 +586,7 @@ class Amiword(Processor):
                 self.output['command'].append(kwargs[key])
 
                                 
+@register
 class Amisequence(Processor):
     def _cmd(self, **kwargs):
         self.output['command'] = ['/usr/bin/ami2-sequence']
@@ -349,7 +597,7 @@ class Amisequence(Processor):
             if k == '--cid':
                 self.output['cid'] = kwargs[key]
                 self.output['command'].append('-q')
-                self.output['command'].append(current_app.config['STORAGE_DIR'] + str(kwargs[key]))
+                self.output['command'] += self._cdirs(kwargs[key])
                 self.output['command'].append('--input')
                 self.output['command'].append('scholarly.html')
             else:
@@ -359,30 +607,50 @@ class Amisequence(Processor):
 '''
 
             
+@register
 class Retrieve(Processor):
     def _cmd(self, **kwargs):
-        self.output['command'] = ['curl']
+        # the url is downloaded in-process by _execute, so the command is just a record of what was fetched to where
+        self.output['command'] = ['GET']
         if len(kwargs) > 0:
             self.output['cid'] = kwargs.get('cid',uuid.uuid4().hex)
-            self.output['store'] = 'http://store.cottagelabs.com/' + self.output['cid']
-            storedir = current_app.config['STORAGE_DIR'] + self.output['cid']
+            self.output['store'] = self.store.url(self.output['cid'])
+            storedir = self.store.dir(self.output['cid'])
             if not os.path.exists(storedir):
                 os.makedirs(storedir)
-            self.output['command'].append('-X')
-            self.output['command'].append('GET')
             if 'url' in kwargs.keys():
                 self.output['command'].append(kwargs['url'])
-                self.output['command'].append('-o')
                 self.output['command'].append(storedir + '/' + kwargs['url'].split('/')[-1])
+
+    def _execute(self):
+        if len(self.output['command']) < 3:
+            self.output['output'] = 'Provide the url of a file to retrieve, and optionally the cid to store it under.'
+            self.output['errors'] = ''
+            return 1
+        # requests is only imported by the processes that download something
+        from cmapi.download import download
+        download(
+            self.output['command'][1], 
+            self.output['command'][2], 
+            size=current_app.config['DOWNLOAD_POOL_SIZE'],
+            timeout=current_app.config['DOWNLOAD_TIMEOUT'],
+            chunk=current_app.config['DOWNLOAD_CHUNK']
+        )
+        self._wrote(os.path.getsize(self.output['command'][2]))
+        self.output['output'] = ''
+        self.output['errors'] = ''
+        return 0
             
     def after(self, **kwargs):
         turl = kwargs.get('url',None)
         if turl is not None:
             fn = turl.split('/')[-1]
             self.output['files'] = []
-            self.output['retrieved'] = self.output['store'] + '/' + fn
-            storedir = current_app.config['STORAGE_DIR'] + self.output['cid']
-            if fn.lower().endswith('pdf'):
+            cid = self.output['cid']
+            self.output['retrieved'] = self.store.url(cid, fn)
+            storedir = self.store.dir(cid)
+            if fn.lower().endswith('pdf') and os.path.exists(os.path.join(storedir, fn)):
+                self.store.unshare(cid, 'unpdf.txt')
                 try:
                     pcmd = [
                         'pdftotext',
@@ -393,49 +661,35 @@ class Retrieve(Processor):
                     p = subprocess.Popen(pcmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
                     self.output['output'], self.output['errors'] = p.communicate()
                     if len(self.output['errors']) == 0:
-                        self.output['unpdf'] = self.output['store'] + '/unpdf.txt'
+                        self.output['unpdf'] = self.store.url(cid, 'unpdf.txt')
                 except Exception, e:
                     self.output['output'] = {}
                     self.output['errors'] = [str(e)]
-                    print self.output
+            if 'unpdf' in self.output and not wait(os.path.join(storedir, 'unpdf.txt'), time.time() + current_app.config['READY_TIMEOUT']):
+                self.output['failures'] = [{"cid": cid, "file": os.path.join(storedir, 'unpdf.txt'), "error": "Text of the PDF was not written."}]
             txt = None
-            time.sleep(5)
-            flsa = os.listdir(storedir)
+            flsa = self.store.sync(cid).keys()
             for fy in flsa:
                 if fy.endswith('.txt'): txt = fy
-            if txt is not None:
-                xfer = True
-                for fa in flsa:
-                    if fy.endswith('.html'): xfer = False
-                if xfer:
-                    new = '<html><head></head><body><p>'
-                    content = open(os.path.join(storedir, txt),'r')
-                    outofpara = False
-                    for line in content.readlines():
-                        if len(line.strip().rstrip('\n')) == 0:
-                            if not outofpara:
-                                new += '</p>\n\n'
-                                outofpara = True
-                        else:
-                            if outofpara:
-                                new += '<p>'
-                                outofpara = False
-                            new += line.rstrip('\n')
-                    content.close()
-                    new += '</p></body></html>'
-                    nf = open(storedir + '/fulltext.html','w')
-                    nf.write(new)
-                    nf.close()
+            if txt is not None and not any(fa.lower().endswith('.html') for fa in flsa):
+                from cmapi.convert import convert
+                # the download is done by now, so having to wait too long for a convert slot is reported as a
+                # failure of the conversion only, rather than as a 429 for the whole retrieve
+                try:
+                    convert(os.path.join(storedir, txt), os.path.join(storedir, 'fulltext.html'), current_app.config)
+                    self._wrote(self.store.put(cid, 'fulltext.html')['size'])
                     self.output['txt2html'] = storedir + '/fulltext.html'
-            fls = os.listdir(storedir)
+                except Busy:
+                    self.output['failures'] = self.output.get('failures',[]) + [{"cid": cid, "file": os.path.join(storedir, 'fulltext.html'), "error": "Too many conversions running, so the text was not converted to html."}]
+            fls = self.store.files(cid)
             for f in fls:
                 if 'fulltext.pdf' not in fls and f.lower().endswith('.pdf'):
-                    shutil.copy(os.path.join(storedir, f), os.path.join(storedir, 'fulltext.pdf'))
+                    self.store.alias(cid, f, 'fulltext.pdf')
                 if 'fulltext.html' not in fls and f.lower().endswith('.html'):
-                    shutil.copy(os.path.join(storedir, f), os.path.join(storedir, 'fulltext.html'))
+                    self.store.alias(cid, f, 'fulltext.html')
                 if 'fulltext.xml' not in fls and f.lower().endswith('.xml'):
-                    shutil.copy(os.path.join(storedir, f), os.path.join(storedir, 'fulltext.xml'))
-            for fl in os.listdir(storedir):
-                self.output['files'].append(self.output['store'] + '/' + fl)
+                    self.store.alias(cid, f, 'fulltext.xml')
+            for fl in self.store.files(cid):
+                self.output['files'].append(self.store.url(cid, fl))
 
                 
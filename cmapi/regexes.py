@@ -0,0 +1,88 @@
+
+'''
+The regex dictionaries in REGEXES_DIR, and the combined files ami2-regex is run with
+The dir is indexed once, and looked at again for changes at most every REGEXES_POLL seconds - only files whose
+size or mtime have changed are read again. ami2-regex takes one regex file, so to run several dictionaries at
+once their regexes are put together into one compoundRegex file, named by a hash of the names and contents of
+the dictionaries in it and kept in REGEXES_CACHE_DIR, so it is only made again when one of them changes.
+The whole set makes up what used to have to be put in REGEXES_DIR by hand as concatenated.xml.
+'''
+
+import os, time, hashlib, threading
+from cmapi.storage import digest
+
+class Dictionaries(object):
+    def __init__(self, path, cachedir, poll=5):
+        self.path = path
+        self.cachedir = cachedir
+        self.poll = poll
+        self.index = {}
+        self.checked = 0
+        self.lock = threading.Lock()
+        self._meta = None
+
+    def refresh(self, force=False):
+        # bring the index up to date with the dir, unless it was looked at less than poll seconds ago
+        with self.lock:
+            if not force and time.time() - self.checked < self.poll: return self.index
+            index = {}
+            try:
+                files = [fl for fl in os.listdir(self.path) if fl.endswith('.xml') and fl != 'concatenated.xml']
+            except OSError:
+                files = []
+            for fl in files:
+                name = fl[:-len('.xml')]
+                st = os.stat(os.path.join(self.path, fl))
+                old = self.index.get(name, None)
+                if old is not None and old['size'] == st.st_size and old['mtime'] == st.st_mtime:
+                    index[name] = old
+                else:
+                    index[name] = {"path": os.path.join(self.path, fl), "size": st.st_size, "mtime": st.st_mtime, "hash": digest(os.path.join(self.path, fl))}
+            if index != self.index: self._meta = None
+            self.index = index
+            self.checked = time.time()
+            return self.index
+
+    def names(self):
+        return sorted(self.refresh().keys())
+
+    def meta(self):
+        # the same dict until the dir changes
+        index = self.refresh()
+        if self._meta is None:
+            self._meta = {'regexes': sorted(index.keys())}
+        return self._meta
+
+    def combined(self, names=None, title='concatenated'):
+        # the path of a regex file of all the regexes of the named dictionaries, or of all of them if no names
+        # are given - returns None if none of them exist
+        index = self.refresh()
+        names = sorted(index.keys()) if names is None else sorted(set(n for n in names if n in index))
+        if len(names) == 0: return None
+        key = hashlib.sha1(title + '\n' + '\n'.join(n + ' ' + index[n]['hash'] for n in names)).hexdigest()
+        dst = os.path.join(self.cachedir, key + '.xml')
+        if os.path.exists(dst): return dst
+        if not os.path.exists(self.cachedir): os.makedirs(self.cachedir)
+        from lxml import etree
+        root = None
+        for n in names:
+            tree = etree.parse(index[n]['path'])
+            if root is None:
+                root = etree.Element(tree.getroot().tag, nsmap=tree.getroot().nsmap)
+                root.set('title', title)
+            for regex in tree.getroot():
+                if isinstance(regex.tag, basestring): root.append(regex)
+        part = dst + '.' + str(os.getpid()) + '.part'
+        etree.ElementTree(root).write(part, xml_declaration=True, encoding='UTF-8')
+        os.rename(part, dst)
+        return dst
+
+
+_dictionaries = {}
+
+def dictionaries(config):
+    # one index per REGEXES_DIR in each process
+    path = config['REGEXES_DIR']
+    if path not in _dictionaries:
+        _dictionaries[path] = Dictionaries(path, config['REGEXES_CACHE_DIR'], config['REGEXES_POLL'])
+    return _dictionaries[path]
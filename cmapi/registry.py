@@ -0,0 +1,62 @@
+
+'''
+The processors the API serves, by route name
+The processors in cmapi/processors.py register themselves with the register decorator as they are defined, and
+load() adds any registered by other packages under the cmapi.processors entry point group, so that a new ami2
+plugin can be served by installing a package with something like this in its setup.py:
+entry_points={'cmapi.processors': ['amiplugin = amiplugin.cmapi:Amiplugin']}
+load() is run once, when the app is made. The meta of processors whose meta does not change is worked out
+once, and the usage of each (which means running its command with no arguments) once it has been got without
+errors, so that those routes do not run anything after the first call.
+'''
+
+import threading
+
+try:
+    import pkg_resources
+except ImportError:
+    pkg_resources = None
+
+PROCESSORS = {}
+_loaded = False
+_lock = threading.Lock()
+_meta = {}
+_usage = {}
+
+def register(cls, name=None):
+    # a class decorator, naming the processor by its class name in lower case unless a name is given
+    PROCESSORS[(name if name is not None else cls.__name__).lower()] = cls
+    return cls
+
+def load():
+    global _loaded
+    with _lock:
+        if _loaded: return PROCESSORS
+        if pkg_resources is not None:
+            for ep in pkg_resources.iter_entry_points('cmapi.processors'):
+                try:
+                    register(ep.load(), ep.name)
+                except Exception, e:
+                    print 'could not load processor ' + ep.name + ' from ' + str(ep.dist) + ': ' + str(e)
+        _loaded = True
+    return PROCESSORS
+
+def get(name):
+    # the processor class of a route name, or None if there is no such processor
+    return PROCESSORS.get(str(name).lower(), None)
+
+def names():
+    return sorted(PROCESSORS.keys())
+
+def meta(name):
+    cls = PROCESSORS[name]
+    if not cls.static_meta: return cls().meta()
+    if name not in _meta: _meta[name] = cls().meta()
+    return _meta[name]
+
+def usage(name):
+    if name not in _usage:
+        res = PROCESSORS[name]().run()
+        if len(res.get('errors',[])) > 0 or 'failures' in res: return res
+        _usage[name] = res
+    return _usage[name]
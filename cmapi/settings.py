@@ -15,6 +15,24 @@ QS_JS_DIR = '/home/cloo/dev/contentmine/src/journal-scrapers/scrapers/'
 QS_TMP_DIR = '/home/cloo/qstmp/'
 REGEXES_DIR = '/home/cloo/dev/contentmine/src/ami-regexes/'
 
+# the combined regex files made from the dictionaries in REGEXES_DIR are kept here, and the dir is looked at for
+# changes at most every REGEXES_POLL seconds
+REGEXES_CACHE_DIR = '/home/cloo/cmapi_regexes/'
+REGEXES_POLL = 5
+
+# where the files of each cid are stored - local is a content addressed store in STORAGE_DIR, s3 also
+# publishes the stored files to the S3 compatible store in STORAGE_S3, and needs boto installed
+STORAGE_BACKEND = 'local'
+STORAGE_URL = 'http://store.cottagelabs.com/'
+STORAGE_S3 = {
+    'host': 'localhost',
+    'port': 9000,
+    'secure': False,
+    'bucket': 'cmapi',
+    'key': '',
+    'secret': ''
+}
+
 #STORAGE_DIR = '/Users/one/sdir/'
 #QS_JS_DIR = '/Users/one/Code/contentmine/src/journal-scrapers/scrapers/'
 #QS_TMP_DIR = '/Users/one/qstmp/'
@@ -25,11 +43,25 @@ HOST = "0.0.0.0"
 DEBUG = True
 PORT = 5111
 WITH_ES = True
+# how the facts index is made if it is not there - once per box (marked in ES_BOOTSTRAP_DIR), by every worker
+# as it starts, or only by python -m cmapi.es bootstrap (cli)
+ES_BOOTSTRAP = 'once'
+ES_BOOTSTRAP_DIR = '/home/cloo/cmapi_bootstrap/'
 ES_HOST = "http://localhost:9200/"
 ES_DB = "contentmine"
 ES_TYPE = "fact"
 FACT_API = ES_HOST + ES_DB + '/' + ES_TYPE + '/'
 MAPPING_URL = ES_HOST + ES_DB + '/_mapping/' + ES_TYPE
+CATALOGUE_API = ES_HOST + ES_DB + '/catalogue/'
+# connections to ES are pooled per worker - timeout is in seconds, backoff doubles from ES_BACKOFF on each retry
+ES_POOL_SIZE = 10
+ES_TIMEOUT = 30
+ES_RETRIES = 3
+ES_BACKOFF = 0.5
+# bytes read at a time when passing ES responses through, and the page size and keepalive for /fact/export
+STREAM_CHUNK = 65536
+EXPORT_SIZE = 500
+EXPORT_SCROLL = '1m'
 MAPPING = {
     "fact" : {
         "properties": {
@@ -71,3 +103,104 @@ MAPPING = {
         ]
     }
 }
+
+# job queue for processor runs called with async=true - run the workers with python -m cmapi.jobs
+# a job whose worker has died JOBS_RETRIES times is failed rather than queued again
+JOBS_DB = '/home/cloo/cmapi_jobs.db'
+JOBS_WORKERS = 4
+JOBS_RETRIES = 3
+
+# number of cids given to each command when a processor that can take several is run with cids
+BATCH_SIZE = 20
+
+# number of facts read at a time when streaming them out of a results file
+TRANSLATE_CHUNK = 1000
+
+# collapse duplicate facts of a cid (same fact, exact or name, and context) into one with a count and offsets
+AGGREGATE_FACTS = True
+
+# facts are sent to the index in bulk, once this many are waiting or this many seconds have passed
+BULK_SIZE = 500
+BULK_INTERVAL = 5
+
+# cache of processor results, keyed on the content of their input files - size in bytes, age in seconds
+CACHE = True
+CACHE_DB = '/home/cloo/cmapi_cache.db'
+CACHE_MAX_SIZE = 500 * 1024 * 1024
+CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+# how long to wait for a processor's output files to be ready once its command has finished
+# polling starts every READY_POLL seconds and backs off to READY_POLL_MAX, giving up after READY_TIMEOUT
+READY_POLL = 0.05
+READY_POLL_MAX = 1
+READY_TIMEOUT = 10
+
+# files fetched by retrieve are downloaded in-process over a pooled session - timeout is in seconds, chunk
+# in bytes. Text is converted to html in-process too, as many at once as ADMISSION_LIMITS['convert'] allows
+DOWNLOAD_POOL_SIZE = 10
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_CHUNK = 65536
+
+# engine of long-lived workers for the JVM tools - run it with python -m cmapi.engine
+# ENGINE_TOOLS maps the command a processor runs to the command that starts a worker for it, e.g.
+# {'/usr/bin/ami2-species': ['java', '-cp', '/usr/share/ami2/ami2.jar', '<worker main class>', '<tool main class>']}
+# workers are restarted after ENGINE_MAX_JOBS jobs, or when over ENGINE_MAX_MEMORY kB resident
+ENGINE = False
+ENGINE_SOCKET = '/tmp/cmapi-engine.sock'
+ENGINE_TOOLS = {}
+ENGINE_WORKERS = 2
+ENGINE_MAX_JOBS = 200
+ENGINE_MAX_MEMORY = 2 * 1024 * 1024
+
+# how many commands of each processor group may run at once across all workers, and how many runs may wait
+# for one - a run that cannot wait, or waits more than ADMISSION_TIMEOUT seconds, gets a 429
+ADMISSION_DIR = '/tmp/cmapi-admission/'
+ADMISSION_LIMITS = {
+    'norma': 2,
+    'ami2': 4,
+    'quickscrape': 8,
+    'convert': 2
+}
+ADMISSION_QUEUE = 16
+ADMISSION_TIMEOUT = 120
+ADMISSION_POLL = 0.2
+ADMISSION_RETRY = 30
+
+# limits on the commands run by each processor - timeout is wall clock seconds, cpu is seconds of CPU time,
+# both per cid, so a batch of cids gets them times the number of cids - memory is MB of address space (leave
+# it None for JVM tools, which reserve far more than they use)
+# only the last OUTPUT_TAIL lines of a command's output are returned, the rest goes to the logs dir of the cid
+PROCESS_LIMITS = {
+    'default': {'timeout': 600, 'cpu': 600, 'memory': None},
+    'quickscrape': {'timeout': 300, 'cpu': 300, 'memory': 2048}
+}
+OUTPUT_TAIL = 200
+
+# a list of urls given to quickscrape is scraped this many at a time, with runs on the same domain started
+# at least QS_DOMAIN_INTERVAL seconds apart
+QS_CONCURRENCY = 8
+QS_DOMAIN_INTERVAL = 1
+
+# the daily harvest, run with python -m cmapi.actions.daily - checkpoints are kept in DAILY_DB, catalogue
+# records are taken DAILY_PAGE at a time, and DAILY_WORKERS articles of a page are fetched at once
+DAILY_DB = '/home/cloo/cmapi_daily.db'
+DAILY_PAGE = 100
+DAILY_WORKERS = 4
+# times a cid that could not be fetched and normalised is tried again by later runs
+DAILY_RETRIES = 3
+DAILY_KEYWORDS = False
+
+# the keyword parser used to enrich facts - blurbs are looked up one at a time, or KEYWORDS_BATCH at a time
+# if set above 1 for a parser that takes a POST of several, at most KEYWORDS_RATE calls a second, each giving
+# up after KEYWORDS_TIMEOUT seconds. The keywords of the last KEYWORDS_CACHE_SIZE blurbs are kept in memory
+# as well as on disk
+KEYWORDS_API = 'http://cottagelabs.com/parser'
+KEYWORDS_BATCH = 1
+KEYWORDS_RATE = 20
+KEYWORDS_TIMEOUT = 30
+KEYWORDS_CACHE_SIZE = 10000
+KEYWORDS_CACHE_DB = '/home/cloo/cmapi_keywords.db'
+
+# the histograms of processor run timings served at /metrics, added up across worker processes in METRICS_DB
+METRICS = True
+METRICS_DB = '/home/cloo/cmapi_metrics.db'
@@ -0,0 +1,67 @@
+
+'''
+Sends facts to the index in bulk
+Facts added to a FactSink are buffered, and flushed to the _bulk endpoint of the index whenever the buffer
+reaches size facts, or interval seconds have passed since the last flush. Call close (or use it in a with
+block) to flush whatever is left. Items that ES rejects as busy or unavailable are retried on their own, with
+backoff, and the counts of indexed and failed facts are kept so they can be reported back.
+'''
+
+import json, uuid, time
+from cmapi import es
+from datetime import datetime
+
+class FactSink(object):
+    def __init__(self, url, size=500, interval=5, retries=3):
+        # url is the index type url, like FACT_API
+        self.url = url
+        self.size = size
+        self.interval = interval
+        self.retries = retries
+        self.buffer = []
+        self.last = time.time()
+        self.counts = {"indexed": 0, "failed": 0, "errors": []}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, fact):
+        if 'id' not in fact: fact['id'] = uuid.uuid4().hex
+        if 'created_date' not in fact: fact['created_date'] = datetime.now().strftime("%Y-%m-%d %H%M")
+        fact['updated_date'] = datetime.now().strftime("%Y-%m-%d %H%M")
+        self.buffer.append(fact)
+        if len(self.buffer) >= self.size or time.time() - self.last >= self.interval:
+            self.flush()
+
+    def flush(self):
+        facts = self.buffer
+        self.buffer = []
+        self.last = time.time()
+        attempt = 0
+        while len(facts) > 0:
+            retry = []
+            try:
+                body = ''.join([json.dumps({"index": {"_id": f['id']}}) + '\n' + json.dumps(f) + '\n' for f in facts])
+                items = es.post(self.url + '_bulk', data=body).json()['items']
+            except Exception, e:
+                # nothing came back about the items, so all of them are tried again
+                items = [{"index": {"status": 503, "error": str(e)}} for f in facts]
+            for fact, item in zip(facts, items):
+                res = item.get('index',item.get('create',{}))
+                if res.get('status',500) < 300:
+                    self.counts['indexed'] += 1
+                elif res.get('status') in [429,503] and attempt < self.retries:
+                    retry.append(fact)
+                else:
+                    self.counts['failed'] += 1
+                    self.counts['errors'].append({"id": fact['id'], "error": res.get('error','')})
+            facts = retry
+            attempt += 1
+            if len(facts) > 0: time.sleep(2 ** attempt)
+        return self.counts
+
+    def close(self):
+        return self.flush()
@@ -0,0 +1,88 @@
+
+'''
+Runs a command as a child process with limits
+The child is started in its own process group, with CPU time and address space rlimits if given, and is killed
+along with anything it started if it runs longer than timeout seconds. The process group and rlimits are set up
+by running this file as a small wrapper that then execs the command, rather than in a preexec_fn, which is not
+safe to run in a child forked from a threaded process such as a pipeline or a quickscrape fanout.
+Only the last tail lines of its stdout and stderr are kept in memory. If a logdir is given the whole of each
+stream is also written to a file there, so nothing is lost however chatty the command is.
+'''
+
+import os, sys, time, signal, resource, subprocess, threading, collections
+
+WRAPPER = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+
+def _wrapped(command, cpu, memory):
+    # the command as run through the wrapper - cpu in seconds, memory in MB, - for no limit
+    limit = lambda v: str(int(v)) if v is not None else '-'
+    return [sys.executable, '-S', WRAPPER, limit(cpu), limit(memory)] + list(command)
+
+def _exec(args):
+    # the wrapper, run in the child in place of the command
+    cpu, memory, command = args[0], args[1], args[2:]
+    os.setsid()
+    if cpu != '-':
+        resource.setrlimit(resource.RLIMIT_CPU, (int(cpu), int(cpu)))
+    if memory != '-':
+        resource.setrlimit(resource.RLIMIT_AS, (int(memory) * 1024 * 1024, int(memory) * 1024 * 1024))
+    try:
+        os.execvp(command[0], command)
+    except OSError, e:
+        sys.stderr.write('could not run ' + command[0] + ': ' + str(e) + '\n')
+        os._exit(127)
+
+def _drain(stream, buf, path):
+    log = open(path, 'w') if path is not None else None
+    try:
+        for line in iter(lambda: stream.readline(65536), ''):
+            buf.append(line)
+            if log is not None: log.write(line)
+    finally:
+        stream.close()
+        if log is not None: log.close()
+
+def spawn(command, timeout=None, cpu=None, memory=None, tail=200, logdir=None, name='command'):
+    # returns the exit code, the tails of stdout and stderr, and whether the command was killed for taking too long
+    p = subprocess.Popen(_wrapped(command, cpu, memory), stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+    if logdir is not None and not os.path.exists(logdir):
+        os.makedirs(logdir)
+    out = collections.deque(maxlen=tail)
+    err = collections.deque(maxlen=tail)
+    readers = [
+        threading.Thread(target=_drain, args=(p.stdout, out, os.path.join(logdir, name + '.stdout.log') if logdir is not None else None)),
+        threading.Thread(target=_drain, args=(p.stderr, err, os.path.join(logdir, name + '.stderr.log') if logdir is not None else None))
+    ]
+    for r in readers:
+        r.daemon = True
+        r.start()
+    deadline = time.time() + timeout if timeout is not None else None
+    delay = 0.01
+    timedout = False
+    while p.poll() is None:
+        if deadline is not None and time.time() > deadline:
+            timedout = True
+            kill(p)
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+    p.wait()
+    for r in readers:
+        r.join(5)
+    return p.returncode, ''.join(out), ''.join(err), timedout
+
+def kill(p, grace=5):
+    # ask the whole process group to stop, then make it
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+        deadline = time.time() + grace
+        while p.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if p.poll() is None:
+            os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+if __name__ == "__main__":
+    _exec(sys.argv[1:])
@@ -0,0 +1,294 @@
+
+'''
+Storage of the files of each cid
+The tools all work on a directory of files per cid, so every backend keeps one of those, at dir(cid).
+The default LocalStore makes it content addressed: each file recorded for a cid is named by the sha1 of its
+content in a blob store under STORAGE_DIR/.blobs, and the file in the cid dir is a hardlink to that blob, so an
+article fetched under two cids is only stored once. The names, hashes and sizes of the files of a cid are kept
+in its manifest under STORAGE_DIR/.manifests, which is what files(cid) reads.
+Blobs are made read only, so that a tool cannot write over a file that other names share - call unshare on a
+file that is about to be written in place. Files written into a cid dir by a tool are recorded with sync.
+A blob is removed once no file of any cid links to it - checked for the old blobs of the names each manifest
+update changes or drops, and for the whole store by python -m cmapi.storage gc (which also clears out blobs left
+by stores from before this was done). Blobs already published to S3 are left there.
+S3Store also publishes every blob and manifest to an S3 compatible store (such as a local minio), and gives
+out urls there - files not yet published, such as one a tool is still writing, get their STORAGE_URL url.
+Which backend is used is set by STORAGE_BACKEND, see store(), which makes one store per process.
+
+The functions promote and alias move and alias plain files without copying them where possible.
+promote moves a file into place with an atomic rename, and only copies it if it is on another device.
+alias makes a second name for a file - as a reflink where the filesystem supports them, otherwise as a
+hardlink, and only as a copy across devices.
+'''
+
+import os, errno, shutil, fcntl, json, hashlib, stat
+
+# the FICLONE ioctl of linux, which makes dst a copy-on-write clone of src on filesystems like btrfs and xfs
+FICLONE = 0x40049409
+
+def promote(src, dst):
+    try:
+        os.rename(src, dst)
+        return 'rename'
+    except OSError, e:
+        if e.errno != errno.EXDEV: raise
+    shutil.copy2(src, dst)
+    os.remove(src)
+    return 'copy'
+
+def _reflink(src, dst):
+    with open(src, 'rb') as s:
+        with open(dst, 'wb') as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                return True
+            except (IOError, OSError):
+                pass
+    os.remove(dst)
+    return False
+
+def alias(src, dst):
+    if os.path.exists(dst): os.remove(dst)
+    if _reflink(src, dst):
+        return 'reflink'
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError, e:
+        if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]: raise
+    shutil.copy(src, dst)
+    return 'copy'
+
+def unshare(path):
+    # replace a file that shares its content with other names by a writable copy of its own
+    if os.path.exists(path) and os.stat(path).st_nlink > 1:
+        part = path + '.part'
+        shutil.copy(path, part)
+        os.chmod(part, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.rename(part, path)
+
+
+def digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), ''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class LocalStore(object):
+    def __init__(self, config):
+        self.root = config['STORAGE_DIR']
+        self.base = config['STORAGE_URL']
+
+    def dir(self, cid):
+        return self.root + str(cid)
+
+    def path(self, cid, name):
+        return os.path.join(self.dir(cid), name)
+
+    def url(self, cid, name=None):
+        return self.base + str(cid) + ('/' + name if name is not None else '')
+
+    def blob(self, digest):
+        return os.path.join(self.root, '.blobs', digest[:2], digest)
+
+    def _lock(self, digest):
+        # held while a blob is linked to or removed, one lock for each of the 256 blob dirs
+        path = os.path.join(self.root, '.blobs', digest[:2] + '.lock')
+        if not os.path.exists(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        lock = open(path, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def collect(self, digest):
+        # remove a blob that no file of a cid links to any more - a cid file that is a reflink or a copy of it
+        # has its own inode, so it loses nothing
+        blob = self.blob(digest)
+        with self._lock(digest):
+            try:
+                if os.stat(blob).st_nlink <= 1:
+                    os.remove(blob)
+                    return True
+            except OSError, e:
+                if e.errno != errno.ENOENT: raise
+        return False
+
+    def gc(self):
+        # collect every blob in the store, returning how many were removed
+        removed = 0
+        top = os.path.join(self.root, '.blobs')
+        for sub in (os.listdir(top) if os.path.isdir(top) else []):
+            if not os.path.isdir(os.path.join(top, sub)): continue
+            for dg in os.listdir(os.path.join(top, sub)):
+                if self.collect(dg): removed += 1
+        return removed
+
+    def _manifest(self, cid):
+        return os.path.join(self.root, '.manifests', str(cid) + '.json')
+
+    def manifest(self, cid):
+        try:
+            with open(self._manifest(cid)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _update(self, cid, changes):
+        # apply changes to the manifest under a lock, as several processors may be working on one cid at once
+        # a change of None removes that name
+        # the blobs of names that now have other content, or none, are collected once it is written
+        mf = self._manifest(cid)
+        if not os.path.exists(os.path.dirname(mf)): os.makedirs(os.path.dirname(mf))
+        old = set()
+        with open(mf + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest = self.manifest(cid)
+            for name, entry in changes.items():
+                if name in manifest and (entry is None or entry['hash'] != manifest[name]['hash']):
+                    old.add(manifest[name]['hash'])
+                if entry is None:
+                    manifest.pop(name, None)
+                else:
+                    manifest[name] = entry
+            with open(mf + '.part', 'w') as f:
+                json.dump(manifest, f)
+            os.rename(mf + '.part', mf)
+        self._published(cid, manifest)
+        for dg in old:
+            self.collect(dg)
+        return manifest
+
+    def _published(self, cid, manifest):
+        pass
+
+    def _stored(self, digest, blob):
+        pass
+
+    def _entry(self, cid, name):
+        # move the content of a file of the cid into the blob store, or drop it for the blob already there,
+        # leaving the file in the cid dir as a link to the blob
+        fl = self.path(cid, name)
+        dg = digest(fl)
+        blob = self.blob(dg)
+        if not os.path.exists(os.path.dirname(blob)): os.makedirs(os.path.dirname(blob))
+        with self._lock(dg):
+            try:
+                if os.path.exists(blob):
+                    alias(blob, fl)
+                else:
+                    os.link(fl, blob)
+                    os.chmod(blob, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                    self._stored(dg, blob)
+            except OSError, e:
+                # the blob store is on another device than the cid dir, so the content is kept in both
+                if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]: raise
+                if not os.path.exists(blob):
+                    shutil.copy(fl, blob)
+                    self._stored(dg, blob)
+        st = os.stat(fl)
+        return {"hash": dg, "size": st.st_size, "mtime": st.st_mtime}
+
+    def put(self, cid, name):
+        # record a file that is in the cid dir
+        return self._update(cid, {name: self._entry(cid, name)})[name]
+
+    def add(self, cid, src, name=None):
+        # move a file from elsewhere into the cid dir, and record it
+        if name is None: name = os.path.basename(src)
+        if not os.path.exists(self.dir(cid)): os.makedirs(self.dir(cid))
+        promote(src, self.path(cid, name))
+        return self.put(cid, name)
+
+    def alias(self, cid, name, target):
+        # give the file name of the cid a second name, target, sharing its content
+        entry = self.manifest(cid).get(name, None)
+        if entry is None: entry = self.put(cid, name)
+        with self._lock(entry['hash']):
+            src = self.blob(entry['hash']) if os.path.exists(self.blob(entry['hash'])) else self.path(cid, name)
+            alias(src, self.path(cid, target))
+        st = os.stat(self.path(cid, target))
+        return self._update(cid, {target: {"hash": entry['hash'], "size": st.st_size, "mtime": st.st_mtime}})[target]
+
+    def sync(self, cid):
+        # record the files a tool has written into the top of the cid dir, and forget those it has removed
+        manifest = self.manifest(cid)
+        changes = {}
+        present = set()
+        if os.path.isdir(self.dir(cid)):
+            for name in os.listdir(self.dir(cid)):
+                fl = self.path(cid, name)
+                if not os.path.isfile(fl) or name.endswith('.part'): continue
+                present.add(name)
+                st = os.stat(fl)
+                if name not in manifest or manifest[name]['size'] != st.st_size or manifest[name]['mtime'] != st.st_mtime:
+                    changes[name] = self._entry(cid, name)
+        for name in manifest.keys():
+            if name not in present: changes[name] = None
+        return self._update(cid, changes) if len(changes) > 0 else manifest
+
+    def files(self, cid):
+        return sorted(self.manifest(cid).keys())
+
+    def unshare(self, cid, name):
+        unshare(self.path(cid, name))
+
+
+class S3Store(LocalStore):
+    def __init__(self, config):
+        LocalStore.__init__(self, config)
+        # boto is slow to import, so only processes that use this backend import it
+        try:
+            import boto
+            from boto.s3.connection import OrdinaryCallingFormat
+        except ImportError:
+            raise ImportError('The s3 storage backend needs boto to be installed.')
+        s3 = config['STORAGE_S3']
+        self.conn = boto.connect_s3(
+            aws_access_key_id=s3['key'],
+            aws_secret_access_key=s3['secret'],
+            host=s3['host'],
+            port=s3['port'],
+            is_secure=s3['secure'],
+            calling_format=OrdinaryCallingFormat()
+        )
+        self.bucket = self.conn.get_bucket(s3['bucket'])
+        self.local = self.base
+        self.base = ('https://' if s3['secure'] else 'http://') + s3['host'] + ':' + str(s3['port']) + '/' + s3['bucket'] + '/'
+
+    def url(self, cid, name=None):
+        if name is None:
+            return self.base + 'manifests/' + str(cid) + '.json'
+        entry = self.manifest(cid).get(name, None)
+        if entry is None: return self.local + str(cid) + '/' + name
+        return self.base + 'blobs/' + entry['hash']
+
+    def _stored(self, digest, blob):
+        self.bucket.new_key('blobs/' + digest).set_contents_from_filename(blob)
+
+    def _published(self, cid, manifest):
+        self.bucket.new_key('manifests/' + str(cid) + '.json').set_contents_from_string(json.dumps(manifest))
+
+
+BACKENDS = {
+    'local': LocalStore,
+    's3': S3Store
+}
+
+_stores = {}
+
+def store(config):
+    # one store per backend and STORAGE_DIR in each process, so that e.g. the S3 connection is made once
+    key = (config.get('STORAGE_BACKEND','local'), config['STORAGE_DIR'])
+    if key not in _stores:
+        _stores[key] = BACKENDS[key[0]](config)
+    return _stores[key]
+
+
+if __name__ == "__main__":
+    import sys
+    from cmapi.app import app
+    if len(sys.argv) > 1 and sys.argv[1] == 'gc':
+        print str(store(app.config).gc()) + ' blobs removed'
+    else:
+        print 'usage: python -m cmapi.storage gc'
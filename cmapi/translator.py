@@ -1,50 +1,140 @@
-from lxml import etree
+# fields whose values repeat across many facts, so that each distinct value is only held once
+INTERNED = ['name', 'exact', 'processor', 'set', 'source']
+MISSING = object()
+
+
+class Facts(object):
+    # a list of facts held as a column per field rather than a dict per fact
+    # it iterates and indexes as dicts, so it can be used wherever a list of fact dicts was
+    # the interned values are kept per Facts, so they go when it does
+    __slots__ = ['fields', 'columns', 'size', 'interned']
+
+    def __init__(self, docs=None):
+        self.fields = []
+        self.columns = {}
+        self.size = 0
+        self.interned = {}
+        if docs is not None: self.extend(docs)
+
+    def _column(self, field):
+        if field not in self.columns:
+            self.fields.append(field)
+            self.columns[field] = [MISSING] * self.size
+        return self.columns[field]
+
+    def append(self, doc):
+        for field, value in doc.items():
+            if field in INTERNED and value is not None: value = self.interned.setdefault(value, value)
+            self._column(field).append(value)
+        self.size += 1
+        for field in self.fields:
+            if len(self.columns[field]) < self.size: self.columns[field].append(MISSING)
+
+    def extend(self, docs):
+        if isinstance(docs, Facts) and self.size == 0 and len(self.fields) == 0:
+            self.interned = docs.interned
+            self.fields = list(docs.fields)
+            self.columns = {field: list(docs.columns[field]) for field in docs.fields}
+            self.size = docs.size
+        else:
+            for doc in docs: self.append(doc)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        return {field: self.columns[field][i] for field in self.fields if self.columns[field][i] is not MISSING}
+
+    def __iter__(self):
+        for i in xrange(self.size):
+            yield self[i]
+
+    def column(self, field):
+        return [None if v is MISSING else v for v in self.columns[field]] if field in self.columns else [None] * self.size
+
+    def set(self, field, values):
+        self._column(field)
+        self.columns[field] = list(values)
+
+    def take(self, rows):
+        # a new Facts of just the given rows
+        taken = Facts()
+        taken.interned = self.interned
+        taken.fields = list(self.fields)
+        taken.columns = {field: [self.columns[field][i] for i in rows] for field in self.fields}
+        taken.size = len(rows)
+        return taken
+
+    def rows(self):
+        return list(self)
+
+    def columnar(self):
+        return {"fields": list(self.fields), "count": self.size, "columns": {field: self.column(field) for field in self.fields}}
+
+
+def encode(obj):
+    # for json.dumps(default=encode), so that output holding Facts serialises as it always has
+    if isinstance(obj, Facts): return obj.rows()
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
 
 class Translator(object):
-    
+
     def __init__(self, processor):
         self.processor = processor
-        
+
     def translate(self, fl):
-        return getattr(self, '_%s' % self.processor)(fl)
-        
-    def _amispecies(self, fl):
-        output = []
-        tree = etree.parse(fl)
-        results = tree.xpath('//result')
-        for result in results:
-            doc = {}
-            doc["pre"] = result.get("pre")
-            doc["exact"] = result.get("exact")
-            doc["fact"] = result.get("match")
-            doc["post"] = result.get("post")
-            doc["name"] = result.get("name")
-            output.append(doc)
-        return output
-
-    def _amiidentifier(self, fl):
-        output = []
-        tree = etree.parse(fl)
-        results = tree.xpath('//result')
-        for result in results:
-            doc = {}
-            doc["pre"] = result.get("pre")
-            doc["fact"] = result.get("exact")
-            doc["post"] = result.get("post")
-            output.append(doc)
-        return output
-
-    def _amiregex(self, fl):
-        output = []    
-        tree = etree.parse(fl)
+        return list(self.iter_translate(fl))
+
+    def iter_translate(self, fl):
+        # stream the result elements out of the file one at a time, clearing each one once it is translated
+        # so that a huge results file never has to be held in memory as a whole tree
+        # lxml is imported here rather than at the top, as the app imports this module for Facts alone
+        from lxml import etree
+        convert = getattr(self, '_%s' % self.processor)
+        for event, result in etree.iterparse(fl, events=('end',), tag='result'):
+            yield convert(result)
+            result.clear()
+            while result.getprevious() is not None:
+                del result.getparent()[0]
+
+    def facts(self, fl):
+        # all the facts of the file, held compactly
+        return Facts(self.iter_translate(fl))
+
+    def chunks(self, fl, size=1000):
+        # the translated facts in lists of at most size
+        chunk = []
+        for doc in self.iter_translate(fl):
+            chunk.append(doc)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def _amispecies(self, result):
+        doc = {}
+        doc["pre"] = result.get("pre")
+        doc["exact"] = result.get("exact")
+        doc["fact"] = result.get("match")
+        doc["post"] = result.get("post")
+        doc["name"] = result.get("name")
+        return doc
+
+    def _amiidentifier(self, result):
+        doc = {}
+        doc["pre"] = result.get("pre")
+        doc["fact"] = result.get("exact")
+        doc["post"] = result.get("post")
+        return doc
+
+    def _amiregex(self, result):
         #results = tree.xpath('//zf:result')
-        results = tree.xpath('//result')
-        for result in results:
-            doc = {}
-            doc["pre"] = result.get("pre")
-            doc["fact"] = result.get("value0")
-            doc["post"] = result.get("post")
-            output.append(doc)
-        return output
-
-    
+        doc = {}
+        doc["pre"] = result.get("pre")
+        doc["fact"] = result.get("value0")
+        doc["post"] = result.get("post")
+        return doc
+
+